@@ -38,7 +38,9 @@ try: from PyQt5.QtGui import QIcon
 except : from PyQt6.QtGui import QIcon
 
 from .shading_algorithm import DemShadingAlgorithm
+from .insolation_algorithm import InsolationAlgorithm
 from .occlusion_algorithm import OcclusionAlgorithm
+from .horizon_algorithm import HorizonAlgorithm
 from .tpi_algorithm import TpiAlgorithm
 from .hillshade_algorithm import HillshadeAlgorithm
 from .texture_algorithm import TextureAlgorithm
@@ -71,6 +73,19 @@ class DemShadingProvider(QgsProcessingProvider):
         ProcessingConfig.addSetting(
             Setting(self.name(), 'BUFFER_SIZE',
                                     'Total buffer size (megapixels)', 500))
+        ProcessingConfig.addSetting(
+            Setting(self.name(), 'THREADS',
+                    'Number of threads (shadow depth), 0 for all processors', 0))
+        ProcessingConfig.addSetting(
+            Setting(self.name(), 'COMPACT',
+                    'Single precision working data (shadow depth, less memory)', False))
+        ProcessingConfig.addSetting(
+            Setting(self.name(), 'DISK_CACHE',
+                    'Keep intermediate results on disk (texture shading spectra, hillshade gradients)', False))
+        ProcessingConfig.addSetting(
+            Setting(self.name(), 'CACHE_FOLDER',
+                    'Cache folder (system temporary folder if empty)', '',
+                    valuetype = Setting.FOLDER))
         
         # not very useful... for further testing
         # ProcessingConfig.addSetting(
@@ -95,8 +110,8 @@ class DemShadingProvider(QgsProcessingProvider):
         """
         
                 # Load algorithms
-        alglist =[DemShadingAlgorithm(),  HillshadeAlgorithm(),
-              OcclusionAlgorithm(),  TpiAlgorithm(),
+        alglist =[DemShadingAlgorithm(), InsolationAlgorithm(), HillshadeAlgorithm(),
+              OcclusionAlgorithm(), HorizonAlgorithm(), TpiAlgorithm(),
             TextureAlgorithm(), ToposhadeAlgorithm(), NodataAlgorithm()]
         
         if self.isActive():
@@ -38,6 +38,7 @@ from qgis.core import (QgsProcessing,
                         QgsProcessingParameterBoolean,
                       QgsProcessingParameterNumber,
                        QgsProcessingParameterEnum,
+                       QgsProcessingParameterString,
 
                        QgsProcessingUtils,
                         QgsRasterBandStats,
@@ -54,7 +55,9 @@ except ImportError:
 import numpy as np
 
 from .modules import Raster as rs
-from .modules.helpers import view, window_loop,  median_filter
+from .modules.helpers import view, window_loop,  median_filter, parse_list
+from .modules.cache import ArrayCache, cache_key
+from .modules.shaders import hillshade_kernel
 
 from qgis.core import QgsMessageLog # for testing
 
@@ -69,6 +72,8 @@ class HillshadeAlgorithm(QgsProcessingAlgorithm):
 
     INPUT = 'INPUT'
     DIRECTION= 'DIRECTION'
+    DIRECTIONS = 'DIRECTIONS'
+    WEIGHTS = 'WEIGHTS'
     BIDIRECTIONAL= 'BIDIRECTIONAL'
     ANGLE = 'ANGLE'
     LON_Z ='LON_Z'
@@ -104,6 +109,16 @@ class HillshadeAlgorithm(QgsProcessingAlgorithm):
             self.tr('Direction (0 to 360°)'),
            QgsProcessingParameterNumber.Double, defaultValue= 315, 
             minValue= 0, maxValue= 360))
+        
+        self.addParameter(QgsProcessingParameterString(
+            self.DIRECTIONS,
+            self.tr('Multiple directions (comma separated, overrides direction)'),
+            optional = True))
+        
+        self.addParameter(QgsProcessingParameterString(
+            self.WEIGHTS,
+            self.tr('Weights of multiple directions (comma separated, equal if empty)'),
+            optional = True))
                 
         self.addParameter(QgsProcessingParameterNumber(
             self.ANGLE,
@@ -153,6 +168,21 @@ class HillshadeAlgorithm(QgsProcessingAlgorithm):
         self.output_model = self.parameterAsOutputLayer(parameters,self.OUTPUT,context)
 
         direction = self.parameterAsDouble(parameters,self.DIRECTION, context)
+        
+        try : 
+            directions = parse_list(self.parameterAsString(parameters,self.DIRECTIONS, context))
+            weights = parse_list(self.parameterAsString(parameters,self.WEIGHTS, context))
+        except ValueError:
+            err = " \n ****** \n ERROR! \n Directions and weights should be numbers, separated by commas !"
+            raise QgsProcessingException(err)
+        
+        directions = directions or [direction]
+        weights = weights or [1] * len(directions)
+        
+        if len(weights) != len(directions) or sum(weights) <= 0 or min(weights) < 0: 
+            err = (" \n ****** \n ERROR! \n Weights should be positive numbers, " 
+                   "one for each direction !")
+            raise QgsProcessingException(err)
 
         bidirectional = self.parameterAsInt(parameters,self.BIDIRECTIONAL, context)  
         # patch to communicate with postprocessing...
@@ -160,8 +190,7 @@ class HillshadeAlgorithm(QgsProcessingAlgorithm):
         self.bidir = bidirectional 
         
         if bidirectional : # because of vector addition, the effective lighting is shifted 
-            direction -= 45  
-            if direction < 0 : direction += 360 
+            directions = [d - 45 for d in directions]
         
               
         sun_angle =  self.parameterAsDouble(parameters,self.ANGLE, context)
@@ -192,10 +221,15 @@ class HillshadeAlgorithm(QgsProcessingAlgorithm):
                
         sun_angle = np.radians( sun_angle)  
             
-        s = np.radians(360 - direction)  # reverse the sequence (more simple than to fiddle with sin/cos...)
+        # weighted average of hillshades (gradients are shared)
+        weights = [w / sum(weights) for w in weights]
+        
+        trig = []
+        for d in directions: 
+            s = np.radians(360 - d % 360)  # reverse the sequence (more simple than to fiddle with sin/cos...)
         
  #       for two prependicualr vectors, directions can be decomposed according to sin/cos rule
-        a, b = np.cos(s) , np.sin(s)     
+            trig.append((np.cos(s) , np.sin(s)))
        
         if smooth :
             # larger matrix, same principle ( standards for hillshades )
@@ -232,83 +266,110 @@ class HillshadeAlgorithm(QgsProcessingAlgorithm):
         mx_z = np.zeros(chunk_slice)
         mx_a = np.zeros(chunk_slice)
         mx_a2 = np.zeros(chunk_slice)
+        
+        chunks = list(window_loop ( 
+            shape = (dem.xsize, dem.ysize), 
+            chunk = dem.chunk_x,
+            overlap = overlap ))
+        
+        # gradients (sums of the filter windows) depend only on the data and the filter :
+        # kept on the disk in single precision, reused when the direction is changed
+        key = (cache_key(dem.qrst.source(), 'gradients', smooth, dem.chunk_x, overlap) 
+               if ProcessingConfig.getSetting('DISK_CACHE') else None)
+        if key : 
+            gradients = ArrayCache(key, [(2,) + mx_z[c[2]].shape for c in chunks], 
+                                   dtype = np.float32, name = 'gradients')
+        else : gradients = None
+                           
+        # preallocated arrays for shading (output, slopes and scratch), 
+        # views are taken for smaller chunks
+        shape = (dem.ysize, max(mx_z[c[2]].shape[1] for c in chunks))
+        buffers = [np.empty(shape) for i in range(5)]
                            
         counter = 0
       
         # loop though data chunks  
-        for mx_view_in, gdal_take, mx_view_out, gdal_put in window_loop ( 
-            shape = (dem.xsize, dem.ysize), 
-            chunk = dem.chunk_x,
-            overlap = overlap ) :
-            
-            # for speed : read into an allocated array
-            dem.rst.ReadAsArray(*gdal_take, mx_z[mx_view_in])
+        for i, (mx_view_in, gdal_take, mx_view_out, gdal_put) in enumerate(chunks) :
             
-            if smooth == 2 : mx_z = median_filter(mx_z, 2)
-            
-            mx_a [:], mx_a2[:] = 0,0
-                       
-            for (y,x), weight in np.ndenumerate(win):
-
-                view_in, view_out = view(y - win_size//2, x - win_size//2, mx_z.shape)
-                          
-                if weight : 
-                    mx_a[view_out] += mx_z[view_in] * weight
-     
-                w2 = win2[y,x]    
-                if w2: 
-                    mx_a2[view_out] += mx_z[view_in] * w2
-                      
-                counter += 1
+            if gradients and gradients.complete : 
+                counter += 9
                 feedback.setProgress(100 * dem.chunk_x * (counter/9) /  dem.xsize)
-                if feedback.isCanceled(): return {}   
+                if feedback.isCanceled(): return {}
+            else : 
+                # for speed : read into an allocated array
+                dem.rst.ReadAsArray(*gdal_take, mx_z[mx_view_in])
+                
+                if smooth == 2 : mx_z = median_filter(mx_z, 2)
+                
+                mx_a [:], mx_a2[:] = 0,0
+                           
+                for (y,x), weight in np.ndenumerate(win):
+    
+                    view_in, view_out = view(y - win_size//2, x - win_size//2, mx_z.shape)
+                              
+                    if weight : 
+                        mx_a[view_out] += mx_z[view_in] * weight
+         
+                    w2 = win2[y,x]    
+                    if w2: 
+                        mx_a2[view_out] += mx_z[view_in] * w2
+                          
+                    counter += 1
+                    feedback.setProgress(100 * dem.chunk_x * (counter/9) /  dem.xsize)
+                    if feedback.isCanceled(): 
+                        if gradients : gradients.discard()
+                        return {}   
+                
+                if gradients : 
+                    gradients.put(i, np.stack([mx_a[mx_view_out], mx_a2[mx_view_out]]))
+            
+            # only the output window is needed (the overlap is for the filter)
+            if gradients : ga, ga2 = gradients.get(i)
+            else : ga, ga2 = mx_a[mx_view_out], mx_a2[mx_view_out]
                     
             # slope = dz / dx;
             px = 1 / (abs(pix_x) * np.sum(win[win >0])) # take 1/dist to use multiplication
             py = 1 / (abs(pix_y) * np.sum(win[win >0]))
             
              
-            # using vector addition to isolate directions, i.e the slope along such directions
-            # (knowing that all but cardinal directions have to be calculated from two vector components)
-            # (proof : for 45° sin = 0,7 ; cos = 0,7, which adds to 1,4 = sqrt(2))
-            lon_z =  mx_a * (py * a) + mx_a2 * (px * b)
-            
-            # attention :  mx_a * -1 (= reverse direction !)
-            lat_z = mx_a * (py * -b) + mx_a2 * (px * a)
-
-            # to adjust slope for sun angle (slope * distance)
-            # mx_a -= np.tan(sun_angle) 
+            out, lon_z, lat_z, t, u = (m[:, : ga.shape[1]] for m in buffers)
+            out[:] = 0
             
-            # everything is cast to an angle (atan), which is costly ...
-            lon = np.arctan(lon_z * lon_factor)
-            lat = np.arctan(lat_z * lat_factor)    
-                 
+            # the gradients are computed once for all directions
+            for (a, b), w in zip(trig, weights):
+                
+                # using vector addition to isolate directions, i.e the slope along such directions
+                # (knowing that all but cardinal directions have to be calculated from two vector components)
+                # (proof : for 45° sin = 0,7 ; cos = 0,7, which adds to 1,4 = sqrt(2))
+                # lon_z =  mx_a * (py * a) + mx_a2 * (px * b)
+                np.multiply(ga, py * a, out = lon_z)
+                np.multiply(ga2, px * b, out = t)
+                lon_z += t
+                
+                # attention :  mx_a * -1 (= reverse direction !)
+                # lat_z = mx_a * (py * -b) + mx_a2 * (px * a)
+                np.multiply(ga, py * -b, out = lat_z)
+                np.multiply(ga2, px * a, out = t)
+                lat_z += t
+                
                 # COSINE LAW (Lambertian reflectance)
                 # a shadow below an illuminated object is a parallelogram
                 # with height = cos(inclination) * true_height and 
                 # width = cos(inclination) * true_width
+                # NB :  cos(arctan(x)) = 1 / sqrt(1+x²)  - no angles are calculated
                 
-            out = np.cos(lon - sun_angle) * np.cos(lat)
-            # NB :  cos(arctan(x)) = 1 / sqrt(1+x²)  - to compress the calculation 
-            # while here we do first arctan, and then cos
-            # but - where to plug the adjustement for the sun angle ??
-
-            if bidirectional:
-                #acessory direction: swap matrices and factors !
-                #lon = lat etc.
-                lat[:] = np.arctan(lon_z * lat_factor)
-                lon[:] = np.arctan(-lat_z * lon_factor)
-                
-                #add two hillshades
-                out += np.cos(lon - sun_angle) * np.cos(lat) 
-                
-                # normalise for byte conversion 
-                if byte: out /= 2            
+                # two hillshades are added for bidirectional : normalise for byte conversion 
+                hillshade_kernel(out, lon_z, lat_z, sun_angle, lon_factor, lat_factor,
+                                 weight = w / 2 if bidirectional and byte else w, 
+                                 bidirectional = bidirectional, 
+                                 scratch = (t, u))
 	    # To be studied : values can be stretched for better contrast, 
 	    # but this may produce unintutuive results in combination with varying sun height
             # out **= gamma 
                     
-            dem.add_to_buffer (out[mx_view_out], gdal_put) 
+            dem.add_to_buffer (out, gdal_put) 
+        
+        if gradients : gradients.close()
         
 
         return {self.OUTPUT: self.output_model}
@@ -374,10 +435,14 @@ class HillshadeAlgorithm(QgsProcessingAlgorithm):
             <b>Bidirectional hillshade</b>: combine with a second hillshade, from a perpendicular direction. IMPORTANT: this will work only when lateral terrain exaggeration is set above 1.0.
             
             <b>Sun direction</b> and <b>sun angle</b> parmeters define horizontal and vertical position of the light source, where 0° is on the North, 90° on the East and 270° on the West.
+            
+            <b>Multiple directions</b>: a list of directions, such as 225, 270, 315, 360, produces a multidirectional hillshade, the weighted average of hillshades from each direction (<b>weights</b>, such as 1, 2, 2, 1, are equal if not given). Surface gradients are calculated only once for all directions.
 
             <b>Lateral and longitudinal Z factor </b> introduce artifical exaggeration of the elevation model, in order to achieve higher shading contrast.   
                 
             <b>Denoise</b>: apply a filter to produce smoother results. 
+            
+            Disk cache: when enabled in plugin settings, surface gradients are saved in the cache folder (for each denoise option). Subsequent runs on the same file, with a different direction, sun angle or Z factors, do not need to read and filter the elevation model. Cache files should be deleted manually. Cached data is identified by the file path, modification time, size and a sample of the content, not by a full checksum : if the elevation model is rewritten in place with the same size (e.g. by a script, within a second), delete its cache files. 
 	    
 	    For more information, check <a href = "https://landscapearchaeology.org/qgis-terrain-shading/" >the manual</a>.
              
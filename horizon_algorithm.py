@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ DemShading - horizon products
+ This algorithm derives sky-view, openness or direct sunlight from
+ horizon angles saved by the ambient occlusion algorithm
+                              -------------------
+        begin                : 2026-10-19
+        copyright            : (C) 2026 by Zoran Čučković
+ ***************************************************************************/
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'Zoran Čučković'
+__date__ = '2026-10-19'
+__copyright__ = '(C) 2026 by Zoran Čučković'
+# This will get replaced with a git SHA1 when you do a git archive
+__revision__ = '$Format:%H$'
+from os import path
+
+try : from PyQt5.QtCore import QCoreApplication
+except ImportError: from PyQt6.QtCore import QCoreApplication
+
+from qgis.core import (QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterRasterLayer,
+                       QgsProcessingParameterRasterDestination,
+                        QgsProcessingParameterBoolean,
+                      QgsProcessingParameterNumber,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingUtils,
+                        QgsRasterBandStats,
+                       QgsSingleBandGrayRenderer,
+                       QgsContrastEnhancement
+                        )
+import numpy as np
+from .modules import Raster as rs
+from .modules.helpers import window_loop
+from .modules.shaders import (HORIZON_NAMES, HORIZON_NODATA, HORIZON_SCALE,
+                              horizon_products)
+
+class HorizonAlgorithm(QgsProcessingAlgorithm):
+    """
+    This algorithm reduces a stack of horizon angles to a single shading product.
+    """
+    # Constants used to refer to parameters and outputs. They will be
+    # used when calling the algorithm from another algorithm, or when
+    # calling from the QGIS console.
+    INPUT = 'INPUT'
+    ANALYSIS_TYPE='ANALYSIS_TYPE'
+    SYMMETRIC='SYMMETRIC'
+    DIRECTION= 'DIRECTION'
+    ANGLE= 'ANGLE'
+    OUTPUT = 'OUTPUT'
+    ANALYSIS_TYPES = ['Sky-view','Openness', 'Inverted openness', 'Direct sunlight']
+    output_model = None #for post-processing
+    def initAlgorithm(self, config):
+        """
+        Here we define the inputs and output of the algorithm, along
+        with some other properties.
+        """
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(
+                self.INPUT,
+                self.tr('Horizon angles (from ambient occlusion)')
+            ) )
+
+        self.addParameter(QgsProcessingParameterEnum (
+            self.ANALYSIS_TYPE,
+            self.tr('Analysis type'),
+            self.ANALYSIS_TYPES,
+            defaultValue=0))
+
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.SYMMETRIC,
+            self.tr('Symmetric angles'),
+            False, False))
+
+        self.addParameter(QgsProcessingParameterNumber(
+            self.DIRECTION,
+            self.tr('Sun direction (0 to 360°), for direct sunlight'),
+            QgsProcessingParameterNumber.Double,
+            defaultValue = 315, minValue= 0, maxValue= 360))
+
+        self.addParameter(QgsProcessingParameterNumber(
+            self.ANGLE,
+            self.tr('Sun angle, for direct sunlight'),
+            QgsProcessingParameterNumber.Double,
+            defaultValue = 10, minValue= 0, maxValue= 90))
+
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                self.OUTPUT,
+            self.tr("Horizon product")))
+
+    def processAlgorithm(self, parameters, context, feedback):
+        """
+        Here is where the processing itself takes place.
+        """
+        horizon_model= self.parameterAsRasterLayer(parameters,self.INPUT, context)
+
+        self.output_model = self.parameterAsOutputLayer(parameters,self.OUTPUT,context)
+
+        product = self.parameterAsInt(parameters,self.ANALYSIS_TYPE, context)
+        symmetric = self.parameterAsInt(parameters,self.SYMMETRIC, context)
+        direction = self.parameterAsDouble(parameters,self.DIRECTION, context)
+        sun_angle =self.parameterAsDouble(parameters,self.ANGLE, context)
+
+        cube = rs.Raster(horizon_model)
+
+        err, fatal = cube.verify_raster()
+        if err: feedback.reportError(err, fatalError = fatal)
+
+        # find the bands by their names (as written by the occlusion algorithm)
+        names = [cube.rst.GetRasterBand(i + 1).GetDescription()
+                 for i in range(cube.rst.RasterCount)]
+
+        prefix = 'minimum_' if product == 2 else 'horizon_'
+        try :
+            bands = [names.index(prefix + n) for n in HORIZON_NAMES]
+        except ValueError:
+            err = (" \n ****** \n ERROR! \n Input is not a horizon angles raster " +
+                   ("with minimum angles !" if product == 2 else "!"))
+            raise QgsProcessingException(err)
+
+        cube.set_output(self.output_model)
+
+        # the whole stack is read for each chunk
+        chunk = max(1, cube.chunk_x // len(names))
+
+        counter = 0
+
+        for mx_view_in, gdal_take, mx_view_out, gdal_put in window_loop (
+            shape = (cube.xsize, cube.ysize),
+            chunk = chunk) :
+
+            mx_h = cube.rst.ReadAsArray(*gdal_take)
+            if mx_h.ndim == 2 : mx_h = mx_h[np.newaxis]
+
+            angles = mx_h[bands].astype(float)
+            angles[angles == HORIZON_NODATA] = np.nan
+            angles /= HORIZON_SCALE
+
+            out = horizon_products(angles, product, symmetric = symmetric,
+                                   sun_azimuth = direction, sun_angle = sun_angle)
+
+            cube.add_to_buffer(out, gdal_put)
+
+            counter += 1
+            feedback.setProgress(100 * chunk * counter /  cube.xsize)
+            if feedback.isCanceled(): return {}
+
+        return {self.OUTPUT: self.output_model}
+
+    def postProcessAlgorithm(self, context, feedback):
+
+        output = QgsProcessingUtils.mapLayerFromString(self.output_model, context)
+        provider = output.dataProvider()
+
+        stats = provider.bandStatistics(1,QgsRasterBandStats.All,output.extent(),0)
+        mean, sd = stats.mean, stats.stdDev
+
+        rnd = QgsSingleBandGrayRenderer(provider, 1)
+        ce = QgsContrastEnhancement(provider.dataType(1))
+        ce.setContrastEnhancementAlgorithm(QgsContrastEnhancement.StretchToMinimumMaximum)
+
+        ce.setMinimumValue(mean-3*sd)
+        ce.setMaximumValue( mean+2*sd)
+
+        rnd.setContrastEnhancement(ce)
+
+        output.setRenderer(rnd)
+
+        output.triggerRepaint()
+
+        return {self.OUTPUT: self.output_model}
+
+    def name(self):
+        """
+        Returns the algorithm name, used for identifying the algorithm. This
+        string should be fixed for the algorithm, and must not be localised.
+        The name should be unique within each provider. Names should contain
+        lowercase alphanumeric characters only and no spaces or other
+        formatting characters.
+        """
+        return 'Horizon products'
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return "Horizon products (sky-view, openness, sunlight)"
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def shortHelpString(self):
+        curr_dir = path.dirname(path.realpath(__file__))
+        h = ( """
+                Derive terrain shading from horizon angles saved by the ambient occlusion algorithm (optional output "Horizon angles"). No new search over the elevation model is made, so the cost does not depend on the search radius.
+                Parameters:
+                 - Analysis type: sky-view and openness are the same as in the ambient occlusion algorithm. Inverted openness uses minimum angles (the horizon of the inverted DEM) and requires these to be saved. Direct sunlight gives 1 for lit and 0 for shaded pixels.
+                 - Symmetric: For each pair of opposite directions, take the one with higher horizon.
+                 - Sun direction and sun angle: position of the sun for direct sunlight. The horizon is interpolated between the two closest search directions.
+                For more information, check <a href = "https://landscapearchaeology.org/qgis-terrain-shading/" >the manual</a>.
+
+                If you find this tool useful, consider to :
+
+             <a href='https://ko-fi.com/D1D41HYSW' target='_blank'><img height='30' style='border:0px;height:36px;' src='%s/help/kofi2.webp' /></a>
+            """) % curr_dir
+
+        return self.tr(h)
+
+    def createInstance(self):
+        return HorizonAlgorithm()
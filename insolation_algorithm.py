@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+/***************************************************************************
+ DemShading
+                                 A QGIS plugin
+ This plugin simulates natural shadows over an elevation model (DEM)
+ Generated by Plugin Builder: http://g-sherman.github.io/Qgis-Plugin-Builder/
+                              -------------------
+        begin                : 2026-10-19
+        copyright            : (C) 2026 by Zoran Čučković
+        email                : cuckovic.zoran@gmail.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+"""
+
+__author__ = 'Zoran Čučković'
+__date__ = '2026-10-19'
+__copyright__ = '(C) 2026 by Zoran Čučković'
+
+from os import path
+
+try : from PyQt5.QtCore import QCoreApplication
+except ImportError: from PyQt6.QtCore import QCoreApplication
+
+from qgis.core import (QgsProcessingException,
+                       QgsProcessingAlgorithm,
+                       QgsProcessingParameterRasterLayer,
+                       QgsProcessingParameterRasterDestination,
+                      QgsProcessingParameterNumber,
+                       QgsProcessingParameterEnum,
+                       QgsProcessingParameterString,
+                        )
+from processing.core.ProcessingConfig import ProcessingConfig
+
+import numpy as np
+from .modules import Raster as rs
+from .modules.helpers import parse_list
+from .modules.shaders import insolation, sun_positions
+
+class InsolationAlgorithm(QgsProcessingAlgorithm):
+    """
+    Shadows cast over an elevation model by a series of sun positions, 
+    summed in a single raster (hours in shadow or relative insolation). 
+    """
+
+    INPUT = 'INPUT'
+    LATITUDE = 'LATITUDE'
+    FIRST_DAY = 'FIRST_DAY'
+    LAST_DAY = 'LAST_DAY'
+    STEP = 'STEP'
+    POSITIONS = 'POSITIONS'
+    ANALYSIS_TYPE = 'ANALYSIS_TYPE'
+    OUTPUT = 'OUTPUT'
+
+    ANALYSIS_TYPES = ['Hours in shadow', 'Relative insolation']
+
+    def initAlgorithm(self, config):
+        """
+        Here we define the inputs and output of the algorithm, along
+        with some other properties.
+        """
+
+        self.addParameter(
+            QgsProcessingParameterRasterLayer(
+                self.INPUT,
+                self.tr('Digital elevation model')
+            ) )
+        
+        self.addParameter(QgsProcessingParameterEnum (
+            self.ANALYSIS_TYPE,
+            self.tr('Analysis type'),
+            self.ANALYSIS_TYPES,
+            defaultValue = 0))
+        
+        self.addParameter(QgsProcessingParameterNumber(
+            self.LATITUDE,
+            self.tr('Latitude (°)'),
+            QgsProcessingParameterNumber.Double,
+            defaultValue = 45, minValue= -90, maxValue= 90))
+        
+        self.addParameter(QgsProcessingParameterNumber(
+            self.FIRST_DAY,
+            self.tr('First day of the year (1 to 365)'),
+            QgsProcessingParameterNumber.Integer,
+            defaultValue = 172, minValue= 1, maxValue= 366))
+        
+        self.addParameter(QgsProcessingParameterNumber(
+            self.LAST_DAY,
+            self.tr('Last day of the year (1 to 365)'),
+            QgsProcessingParameterNumber.Integer,
+            defaultValue = 172, minValue= 1, maxValue= 366))
+        
+        self.addParameter(QgsProcessingParameterNumber(
+            self.STEP,
+            self.tr('Time step (minutes)'),
+            QgsProcessingParameterNumber.Integer,
+            defaultValue = 30, minValue= 1, maxValue= 1440))
+        
+        self.addParameter(QgsProcessingParameterString(
+            self.POSITIONS,
+            self.tr('Sun positions : direction, angle, weight; ... (overrides dates)'),
+            optional = True))
+
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                self.OUTPUT,
+            self.tr("Insolation")))
+        
+    def processAlgorithm(self, parameters, context, feedback):
+        """
+        Here is where the processing itself takes place.
+        """
+
+# 1) -------------- INPUT -----------------
+        elevation_model= self.parameterAsRasterLayer(parameters,self.INPUT, context)
+
+        self.output_model = self.parameterAsOutputLayer(parameters,self.OUTPUT,context)
+
+        mode = self.parameterAsInt(parameters,self.ANALYSIS_TYPE, context)
+        
+        latitude = self.parameterAsDouble(parameters,self.LATITUDE, context)
+        first_day = self.parameterAsInt(parameters,self.FIRST_DAY, context)
+        last_day = self.parameterAsInt(parameters,self.LAST_DAY, context)
+        step = self.parameterAsInt(parameters,self.STEP, context)
+        
+        positions, weights = [], []
+        try : 
+            for p in self.parameterAsString(parameters,self.POSITIONS, context).split(';'):
+                p = parse_list(p)
+                if not p : continue
+                if not 2 <= len(p) <= 3 : raise ValueError
+                positions.append((p[0] % 360, p[1]))
+                weights.append(p[2] if len(p) == 3 else 1)
+        except ValueError:
+            err = (" \n ****** \n ERROR! \n Sun positions should be given as "
+                   "direction, angle and (optional) weight, separated by semicolons !")
+            raise QgsProcessingException(err)
+        
+        if not positions : 
+            # merge close positions : each one is a full pass over the data 
+            merged = {}
+            for a, e in sun_positions(latitude, first_day, last_day, step):
+                k = (round(a) % 360, round(e * 2) / 2)
+                merged[k] = merged.get(k, 0) + step / 60 # hours
+            # very low positions are rounded to zero : no illumination anyway
+            positions = [k for k in merged if k[1] > 0]
+            weights = [merged[k] for k in positions]
+        
+        if not positions : 
+            err = " \n ****** \n ERROR! \n The sun is below the horizon for the given dates !"
+            raise QgsProcessingException(err)
+        
+        if any(e <= 0 or e >= 90 for a, e in positions):
+            err = " \n ****** \n ERROR! \n Sun angles should be between 0 and 90° !"
+            raise QgsProcessingException(err)
+            
+        feedback.pushInfo(self.tr('{} sun positions').format(len(positions)))
+        
+        dem = rs.Raster(elevation_model)
+        
+        err, fatal = dem.verify_raster()
+        if err: feedback.reportError(err, fatalError = fatal)
+
+        dem.set_output(self.output_model)
+        
+        # 2) -------   SHADOWS, SUMMED IN A SINGLE BUFFER -------------
+        threads = int(ProcessingConfig.getSetting('THREADS') or 0)
+        # single precision : half the memory, and faster
+        dtype = np.float32 if ProcessingConfig.getSetting('COMPACT') else np.float64
+        
+        OK = insolation(dem, positions, weights, mode = mode, 
+                        feedback = feedback, threads = threads, 
+                        dtype = dtype)
+        
+        return {self.OUTPUT: self.output_model}
+
+    def name(self):
+        """
+        Returns the algorithm name, used for identifying the algorithm. This
+        string should be fixed for the algorithm, and must not be localised.
+        The name should be unique within each provider. Names should contain
+        lowercase alphanumeric characters only and no spaces or other
+        formatting characters.
+        """
+        return 'Insolation'
+
+    def displayName(self):
+        """
+        Returns the translated algorithm name, which should be used for any
+        user-visible display of the algorithm name.
+        """
+        return self.tr(self.name())
+
+    def tr(self, string):
+        return QCoreApplication.translate('Processing', string)
+
+    def shortHelpString(self):
+        curr_dir = path.dirname(path.realpath(__file__))
+        h = ( """
+            <h3>    This algorithm sums shadows cast over an elevation model by a series of sun positions.
+             
+            <b>Input</b> should be an elevation model in raster format. 
+            
+            <b>Analysis type</b>: <b>hours in shadow</b> counts the time (or the sum of weights) when each pixel is in the shadow. <b>Relative insolation</b> sums the direct illumination of lit pixels (cosine of the incidence angle), relative to an open, flat surface: 1 equals the illumination of a flat plain, while steep slopes facing the sun may receive more.
+            
+            <b>Latitude</b>, <b>first and last day of the year</b> and <b>time step</b> define the sun positions (for instance, 172 is the 21st of June; the last day may precede the first one, over the new year). A simple astronomical model is used: time is solar time, the refraction of the atmosphere is not taken into account. Positions closer than 1° in direction and 0.5° in angle are merged.
+            
+            <b>Sun positions</b>: a list such as 135, 30, 2; 180, 45, 1; 225, 30, 2 (direction, angle and optional weight, separated by semicolons) replaces the positions calculated from dates.
+            
+            Processing time grows with the number of sun positions, while the memory use stays close to a single shadow depth analysis: no intermediate results are saved. Positions processed in the same order (e.g. all directions between 135° and 225°) share the reading of the elevation model.
+
+            For more information, check <a href = "https://landscapearchaeology.org/qgis-terrain-shading/" >the manual</a>.
+
+	    If you find this plugin useful, consider to : 
+             <a href='https://ko-fi.com/D1D41HYSW' target='_blank'><img height='30' style='border:0px;height:36px;' src='%s/help/kofi2.webp' /></a>
+            """) % curr_dir
+		
+        return self.tr(h)
+
+    def createInstance(self):
+        return InsolationAlgorithm()
@@ -94,8 +94,8 @@ class Raster:
         self.extent = [raster_x_min, raster_y_min, 
                        raster_x_max, raster_y_max]
 
-        self.min, self.max = gdal_raster.GetRasterBand(1
-                            ).GetStatistics(True, True)[:2]
+        self.min, self.max, self.mean = gdal_raster.GetRasterBand(1
+                            ).GetStatistics(True, True)[:3]
 
          # Could also : 
 ##        raster_max= ..GetRasterBand(1).GetMaximum()
@@ -111,6 +111,8 @@ class Raster:
         buffer =  int(ProcessingConfig.getSetting('BUFFER_SIZE')) * 1000000
         self.chunk_x = min(chunk // xs, xs)
         self.chunk_y = min( chunk // ys, ys) 
+        self.chunk_size = chunk
+        self.buffer_size = buffer
         if xs * ys <= buffer:
             self.buffer = np.zeros((ys, xs))
         else: 
@@ -146,7 +148,8 @@ class Raster:
     def take (self, gdal_take, matrix_in, fill_nodata=None, data_type = float):
         
         bd = self.rst.GetRasterBand(1)
-        bd.ReadAsArray(*gdal_take, matrix_in).astype(data_type)
+        # buf_obj has to be named (the fifth positional argument is buf_xsize)
+        bd.ReadAsArray(*gdal_take, buf_obj = matrix_in)
         
         if not fill_nodata is None: 
             
@@ -159,29 +162,36 @@ class Raster:
         
     def add_to_buffer(self, matrix, gdal_put, 
                       mode = DUMP, 
-                      automatic_save = True):
+                      automatic_save = True,
+                      band = None):
         """
         Save to buffered numpy array (or directly to disk if the array is too large)
         Attention : automatic save is executed when the end of raster is reached,
         which does not work with reverse reading (back to front). Use write_output() to force saving.
+        Band : write a single band of a multiband output (counting from 0).
         """
         
         x, y, x_off, y_off = gdal_put 
         try:
-                      
-            view =  self.buffer [y : y + y_off , x : x + x_off] 
+            # multiband buffers have bands in the first dimension
+            buffer = (self.buffer if band is None or self.buffer.ndim == 2 
+                      else self.buffer[band])
+            view =  buffer [..., y : y + y_off , x : x + x_off] 
             
             if mode == DUMP: view[:] = matrix
             elif mode == ADD : view += matrix
       
         except: 
-           
-            bd = self.gdal_output.GetRasterBand(1)
-            if mode == ADD: 
-                matrix += bd.ReadAsArray(*gdal_put)
-                
-            bd.WriteArray(matrix, *gdal_put[:2])
-            bd.FlushCache() # Important, otherwise it's not saving
+            
+            bands = matrix if matrix.ndim == 3 else [matrix]
+            
+            for i, band_matrix in enumerate(bands):
+                bd = self.gdal_output.GetRasterBand((band or 0) + i + 1)
+                if mode == ADD: 
+                    band_matrix += bd.ReadAsArray(*gdal_put)
+                    
+                bd.WriteArray(band_matrix, *gdal_put[:2])
+                bd.FlushCache() # Important, otherwise it's not saving
             
         
         
@@ -192,11 +202,17 @@ class Raster:
     def set_output (self, file_name,
                      no_data = np.nan,
                      data_format_override = None,
-                     compression = True):
+                     compression = True,
+                     bands = 1,
+                     band_names = None,
+                     rescale = True):
         """
          Prepare output file and set number format. No saving is made at this stage.
          It vill provide a handle (self.gdal_output) which can be used to control writing to disk.
-       
+         
+         Multiband output : data is expected as (bands, y, x) matrices. 
+         Rescale : normalise values when converting to integer formats 
+         (set to False for data that is already encoded, e.g. horizon angles).
         """
         
         if data_format_override:
@@ -219,15 +235,25 @@ class Raster:
                 ]
       
         ds = driver.Create(file_name, self.xsize, self.ysize, 
-                           1, self.data_format, options)
+                           bands, self.data_format, options)
 
         ds.SetProjection(self.rst.GetProjection())
         ds.SetGeoTransform(self.rst.GetGeoTransform())
 
-        ds.GetRasterBand(1).SetNoDataValue(no_data)           
+        for i in range(bands):
+            ds.GetRasterBand(i + 1).SetNoDataValue(no_data)
+            if band_names : ds.GetRasterBand(i + 1).SetDescription(band_names[i])
         #ds.GetRasterBand(1).Fill(self.fill)
         
         self.gdal_output = ds    # a handle for adding data 
+        self.rescale = rescale
+        
+        # the buffer has to hold all bands (or we write directly to disk)
+        if bands > 1 :
+            if bands * self.xsize * self.ysize <= self.buffer_size:
+                self.buffer = np.zeros((bands, self.ysize, self.xsize))
+            else: 
+                self.buffer = None
         
         
     
@@ -237,14 +263,16 @@ class Raster:
 
             # convert formats (normalise first)
             # conversion when working outside the buffer is NOT implemented yet. 
-            if self.data_format != FLOAT : 
+            if self.data_format != FLOAT and self.rescale : 
                 sd, max_val, median = np.std(self.buffer), np.max(abs(self.buffer)), np.median(self.buffer)
                 if max_val > median  +  5 * sd : max_val = median  +  5 * sd 
                 self.buffer /= max_val
                 if self.data_format == INT:  self.buffer *= 32767 
                 elif self.data_format == BYTE: self.buffer *= 255 
 
-            self.gdal_output.GetRasterBand(1).WriteArray(self.buffer)
+            bands = self.buffer if self.buffer.ndim == 3 else [self.buffer]
+            for i, band_matrix in enumerate(bands):
+                self.gdal_output.GetRasterBand(i + 1).WriteArray(band_matrix)
             
         self.gdal_output = None # to save the raster (buffered or non-buffered)
             
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Disk cache for intermediate results (memory-mapped sidecar files),
+and scratch files for data that does not fit in memory.
+
+Forward FFT spectra of an elevation model depend only on the data and
+on the chunk plan : when a parameter such as alpha is changed,
+they can be read from the disk instead of being recomputed. 
+The same holds for surface gradients (hillshade), when only 
+the direction of light is changed.
+
+The key is made of the raster path, its modification time and size,
+a digest of sampled blocks of its content, and of the chunk plan. 
+It is not a full checksum : a file rewritten in place with the same size, 
+within the resolution of modification times and with changes outside 
+the sampled blocks, would not be detected.
+"""
+import os
+import tempfile
+import hashlib
+
+import numpy as np
+
+
+def cache_folder ():
+    """
+    Cache folder from plugin settings (system temp folder if not set).
+    """
+    # imported here : the processing engine (shaders) loads without QGIS (tests)
+    from processing.core.ProcessingConfig import ProcessingConfig
+    
+    folder = ProcessingConfig.getSetting('CACHE_FOLDER')
+    if not folder :
+        folder = os.path.join(tempfile.gettempdir(), 'terrain_shading_cache')
+    os.makedirs(folder, exist_ok = True)
+    return folder
+
+def content_digest (path, samples = 16, block = 65536):
+    """
+    Digest of the file content, from blocks spread evenly over the file 
+    (the whole content for small files) : reading cost does not depend 
+    on the file size.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha1()
+    with open(path, 'rb') as f :
+        if size <= samples * block : 
+            h.update(f.read())
+        else :
+            for i in range(samples):
+                f.seek(i * (size - block) // (samples - 1))
+                h.update(f.read(block))
+    return h.hexdigest()
+
+def cache_key (source, *plan):
+    """
+    Key for a raster file and a processing plan (any printable values).
+    Returns None if the source is not a file (e.g. a web service).
+    """
+    try :
+        stat = os.stat(source)
+        digest = content_digest(source)
+    except (OSError, TypeError) :
+        return None
+
+    s = repr((os.path.abspath(source), stat.st_mtime_ns, stat.st_size, 
+              digest, plan))
+    return hashlib.sha1(s.encode()).hexdigest()
+
+def scratch (shape, dtype = np.float32):
+    """
+    Uncompressed array on the disk (in the cache folder), for intermediate 
+    results that do not fit in memory. 
+    It is a temporary file : removed when the array is released.
+    """
+    f = tempfile.TemporaryFile(dir = cache_folder())
+    return np.memmap(f, dtype = dtype, mode = 'w+', shape = shape)
+
+
+class ArrayCache:
+    """
+    A sequence of arrays of known shapes (one per data chunk, e.g. FFT 
+    spectra or surface gradients), in a single memory-mapped sidecar file. 
+    The name is a prefix of the file name.
+
+    If the file exists, the arrays are read (self.complete = True).
+    Otherwise they should be written with put() : the file is
+    renamed to its final name only when close() is called, so that
+    interrupted runs are not reused. Cancelled runs should call discard().
+    """
+    def __init__(self, key, shapes, dtype = np.float32, name = 'cache'):
+
+        self.shapes = [tuple(s) for s in shapes]
+        self.offsets = [0]
+        for s in self.shapes: self.offsets.append(self.offsets[-1] + int(np.prod(s)))
+
+        self.path = os.path.join(cache_folder(), '{}_{}.npy'.format(name, key))
+        self.temp_path = self.path[:-4] + '_part.npy'
+
+        self.complete = os.path.exists(self.path)
+
+        if self.complete :
+            self.mx = np.load(self.path, mmap_mode = 'r')
+            # should not happen, unless the key is not unique
+            if self.mx.shape[0] != self.offsets[-1] or self.mx.dtype != dtype:
+                del self.mx
+                self.complete = False
+
+        if not self.complete :
+            self.mx = np.lib.format.open_memmap(self.temp_path, mode = 'w+',
+                                                dtype = dtype,
+                                                shape = (self.offsets[-1],))
+
+    def get (self, i):
+        return self.mx[self.offsets[i] : self.offsets[i+1]].reshape(self.shapes[i])
+
+    def put (self, i, matrix):
+        self.mx[self.offsets[i] : self.offsets[i+1]] = matrix.ravel()
+
+    def close (self):
+        if not self.complete :
+            self.mx.flush()
+            del self.mx # release the file (for Windows)
+            os.replace(self.temp_path, self.path)
+
+    def discard (self):
+        """
+        Remove an unfinished file (e.g. on cancel). Complete files are kept.
+        """
+        if not self.complete and hasattr(self, 'mx') :
+            del self.mx
+            try : os.remove(self.temp_path)
+            # still mapped (Windows) : it is overwritten by the next run
+            except OSError : pass
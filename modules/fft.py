@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+FFT backend : scipy.fft when available (multithreaded), numpy.fft otherwise.
+
+Both keep single precision for float32 input (numpy from version 2.0),
+which is faster and takes half the memory.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+try:
+    import scipy.fft as backend
+    BACKEND = 'scipy'
+    # use all processor cores
+    OPTIONS = {'workers' : -1}
+except ImportError:
+    backend = np.fft
+    BACKEND = 'numpy'
+    OPTIONS = {}
+
+from .helpers import nextprod
+
+
+def rfft (a, n = None, axis = -1):
+    return backend.rfft(a, n, axis = axis, **OPTIONS)
+
+def irfft (a, n = None, axis = -1):
+    return backend.irfft(a, n, axis = axis, **OPTIONS)
+
+def rfft2 (a, s = None, axes = (-2, -1)):
+    return backend.rfft2(a, s, axes = axes, **OPTIONS)
+
+def irfft2 (a, s = None, axes = (-2, -1)):
+    return backend.irfft2(a, s, axes = axes, **OPTIONS)
+
+@lru_cache(maxsize = 1024)
+def fast_len (n):
+    """
+    Padded length, at least n, with fast FFT (small prime factors only).
+    The same for both backends (results should not depend on the backend).
+    """
+    return nextprod([2, 3, 5, 7], n)
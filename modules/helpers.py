@@ -41,7 +41,7 @@ def view (offset_y, offset_x, shape, step=1, edge=0):
 
 
 def window_loop (shape, chunk, 
-                 axis = 0, reverse = False, overlap = 0, offset = 0):
+                 axis = 0, reverse = False, overlap = 0):
             """
             Construct a frame to extract chunks of data from gdal
             (and to insert them properly to a numpy matrix)
@@ -49,15 +49,16 @@ def window_loop (shape, chunk,
             xsize, ysize = shape if axis == 0 else shape[::-1]
                         
             if reverse : 
-                begin, step, stride = xsize, 1 + xsize // chunk, -1
+                # the first window is the last one of the forward loop
+                begin, step, stride = xsize, -(-xsize // chunk), -1
             else: 
                 begin, step, stride = 0, 0, 1
 
             x, y, x_off, y_off = 0,0, xsize, ysize
             
-            end = 1
+            end = begin
             
-            while xsize > end > 0 : 
+            while (end > 0) if reverse else (end < xsize) : 
            
                 step += stride
 
@@ -66,11 +67,6 @@ def window_loop (shape, chunk,
                 if reverse :  x, x_off = end, begin - end
                 else:         x, x_off = begin, end - begin
                 
-                # move window front or back, which means only one margin will overlap
-                if (offset < 0 and x >= abs(offset)) or (
-                    offset > 0 and x <= xsize-offset) : 
-                    x += offset * int(step)
-                
                 begin = end
                 
                # ov = overlap * int(step)
@@ -91,21 +87,156 @@ def window_loop (shape, chunk,
                     # we need precise coords for GDAL
                 in_view = np.s_[:,: x_in_off] if not axis else np.s_[: x_in_off, :]
 
-                x_out = x if ov_left == ov else 0
-
-                x_out_off = x_off + (ov_left if ov_left < ov else 0) + (ov_right if ov_right < ov else 0) 
+                # write the chunk itself, without overlaps : chunks do not 
+                # overlap, so the raster end is reached only once (automatic save)
+                x_out, x_out_off = x, x_off
 
                 if not axis : gdal_put =(x_out, y, x_out_off, y_off)
                 else: gdal_put = (y, x_out, y_off, x_out_off)
                 
-                sx = slice(0 if ov_left < ov else ov , 
-                           x_out_off + ov_left + (ov_right if ov_right < ov else 0))
+                sx = slice(ov_left, ov_left + x_out_off)
 
                 out_view = np.s_[:, sx] if not axis else np.s_[sx , :]
           
                 yield in_view, gdal_take, out_view, gdal_put
 
 
+def tile_loop (shape, chunk_x, chunk_y, overlap = 0):
+    """
+    Two dimensional version of window_loop : tiles of chunk_x by chunk_y pixels, 
+    with overlap on all sides (clipped at raster edges).
+    Yields the same frames as window_loop (views are relative to the tile).
+    """
+    for _, (x_in, _, x_in_off, _), _, (x, _, x_off, _) in window_loop(
+            shape, chunk_x, overlap = overlap):
+        
+        for _, (_, y_in, _, y_in_off), _, (_, y, _, y_off) in window_loop(
+                shape, chunk_y, axis = 1, overlap = overlap):
+            
+            in_view = np.s_[: y_in_off, : x_in_off]
+            out_view = np.s_[y - y_in : y - y_in + y_off, x - x_in : x - x_in + x_off]
+            
+            yield in_view, (x_in, y_in, x_in_off, y_in_off), out_view, (x, y, x_off, y_off)
+
+
+def taper (size, halo, start = True, end = True):
+    """
+    Apodization window (1D) : cosine ramps over the halo, at the start 
+    and/or at the end. Use as weights for overlapping FFT tiles. 
+    """
+    w = np.ones(size)
+    if halo : 
+        ramp = 0.5 - 0.5 * np.cos(np.pi * (np.arange(halo) + 0.5) / halo)
+        if start : w[: halo] *= ramp[: size]
+        if end : w[-halo :] *= ramp[::-1][-size :]
+    return w
+
+
+def transpose_blocks (src, dst, side, add = False):
+    """
+    Transpose the last two dimensions of src to dst (dst = src.T, or dst += src.T), 
+    by square blocks : with memory mapped files, data is read and written 
+    in runs of side values, instead of single values scattered over the file.
+    """
+    ny, nx = src.shape[-2:]
+    for y in range(0, ny, side):
+        for x in range(0, nx, side):
+            block = np.array(src[..., y : y + side, x : x + side]).swapaxes(-1, -2)
+            if add : dst[..., x : x + side, y : y + side] += block
+            else : dst[..., x : x + side, y : y + side] = block
+
+
+def line_prefix (matrix, dy, dx, pad, second_order = False):
+    """
+    Cumulative sums along straight lines of a matrix (columns, rows or diagonals).
+    - dy, dx : line direction, dy is 0 or 1 and dx is -1, 0 or 1
+    - pad : zero padding around the matrix, has to be longer than 
+      the longest run to be summed (see line_sum)
+    - second_order : add cumulative sums of cumulative sums (for distance weights) 
+    Returns a list of padded matrices, to be used with line_sum(). 
+    """
+    sy, sx = matrix.shape
+    
+    s = np.zeros((sy + 2 * pad, sx + 2 * pad))
+    s[pad : pad + sy, pad : pad + sx] = matrix
+    
+    sums = [_cumsum_line(s, dy, dx)]
+    if second_order : sums.append(_cumsum_line(sums[0].copy(), dy, dx))
+    
+    return sums
+
+def _cumsum_line (s, dy, dx):
+    """ In place cumulative sum along lines (see line_prefix) """
+    
+    if not dy : return np.cumsum(s, axis = 1, out = s)
+    if not dx : return np.cumsum(s, axis = 0, out = s)
+    
+    # diagonals : add the previous value on the line, 
+    # looping over the shorter dimension (chunks are usually narrow strips)
+    sy, sx = s.shape
+    if sx <= sy: 
+        columns = range(1, sx) if dx > 0 else range(sx - 2, -1, -1)
+        for j in columns: s[1:, j] += s[:-1, j - dx]
+    else: 
+        for i in range(1, sy): 
+            if dx > 0 : s[i, 1:] += s[i - 1, :-1]
+            else : s[i, :-1] += s[i - 1, 1:]
+    return s
+    
+def line_sum (sums, dy, dx, pad, shape, first, last, 
+              linear = False, backward = False):
+    """
+    For each pixel, sum the values found from `first` to `last` steps 
+    along (dy, dx) line, or in the opposite direction (backward). 
+    Values beyond matrix edges are zero. The cost does not depend on the run length.
+    - sums : from line_prefix (second order is needed for linear weights)
+    - linear : each value is multiplied by its distance (number of steps)
+    """
+    sy, sx = shape
+    
+    def at (m, k): # values k steps away from each pixel
+        y, x = pad + k * dy, pad + k * dx
+        return m[y : y + sy, x : x + sx]
+    
+    S = sums[0]
+    
+    if not backward : 
+        if not linear: return at(S, last) - at(S, first - 1)
+        T = sums[1]
+        return (last * at(S, last) - first * at(S, first - 1) 
+                - at(T, last - 1) + at(T, first - 1))
+    else : 
+        if not linear: return at(S, -first) - at(S, -last - 1)
+        T = sums[1]
+        return ((first - 1) * at(S, -first) - last * at(S, -last - 1) 
+                + at(T, -first) - at(T, -last - 1))
+    
+
+def parse_list (text, dtype = float):
+    """
+    Parse a list of numbers separated by commas or spaces (e.g. "5, 10, 20").
+    Ranges are written as start:stop:step, stop included (e.g. "90:180:15"), 
+    the step is 1 by default. 
+    Empty text gives an empty list. Raises ValueError for invalid numbers.
+    """
+    out = []
+    for v in text.replace(',', ' ').split():
+        if ':' not in v : 
+            out.append(dtype(v))
+            continue
+        
+        r = [float(n) for n in v.split(':')]
+        if len(r) == 2 : r.append(1)
+        if len(r) != 3 or r[2] == 0 : raise ValueError(v)
+        
+        start, stop, step = r
+        # tolerance for inexact steps (e.g. 0.1)
+        n = int(np.floor((stop - start) / step + 1e-9)) + 1
+        out += [dtype(start + i * step) for i in range(max(n, 0))]
+    
+    return out
+    
+
 # ======= TODO : a class to handle filtering ==============
 #class Convolve:
 #               - 3x3 filter
@@ -121,10 +252,11 @@ def filter3 (raster, mode='average'):
     average = mode == 'average'
     laplace = mode == 'laplacian'
     
-    temp_matrix = np.zeros(raster.shape)
+    # keep the precision of the input (e.g. single precision data)
+    temp_matrix = np.zeros(raster.shape, dtype = raster.dtype)
     
     if average : 
-        temp_count = np.zeros(raster.shape)
+        temp_count = np.zeros(raster.shape, dtype = raster.dtype)
         # set borders first  
         temp_count[:]= 6
         # main area : 9 points to test 
@@ -9,53 +9,168 @@ import numpy as np
 
 from typing import List
 import math
+import os
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
-from .Raster import Raster as rs
-from .helpers import view, window_loop, median_filter
+from .cache import ArrayCache, cache_key, scratch
+from . import fft
+from .helpers import (view, window_loop, tile_loop, taper, filter3, 
+                      median_filter, line_prefix, line_sum, transpose_blocks)
 
 
 
-def visits_matrix(matrix_shape, radius,
-                  distance_weighted = False,
-                  diagonals=False, diagonal_weight = 1, exclusion=0):
-    """ 
-    pre-calculate the number of visits per cell 
+@lru_cache(maxsize = 64)
+def edge_counts (shape, radius, lines, mode = 0, exclusion = 0, 
+                 edges = (True, True, True, True), pairs = False):
+    """
+    Sum of weights per pixel for line neighbourhoods (cf. weighted_line_sums), 
+    to normalise weighted sums. Pixels further than radius from raster edges 
+    all have the same count (a single value), closer ones are handled 
+    by border strips : no full size matrix is needed. 
     (cannot be done for height based weights)
-    Considering mass displacement mode, the problem is to handle edges -> 
-    they have shorter radii and are not always affected by displacement ...
+    - lines : tuple of (dy, dx, weight, limit), both directions are counted
+      (limit is the offset of light and heavy regions, see line_weights)
+    - mode : 0 = uniform, 1 = distance weighted, 2 = inverse distance
+    - edges : matrix sides which are raster edges (top, bottom, left, right), 
+      data is available beyond other sides (chunk overlap)
+    - pairs : opposite directions count once, if any is available (occlusion)
+    Returns a list of (view, counts) : the interior is given by a single value.
+    Cached : do not modify !
     """
+    sy, sx = shape
+    top, bottom, left, right = edges
     
-    sy, sx = matrix_shape
-    mx_cnt = np.zeros((sy, sx))
+    steps = np.arange(1, radius + 1, dtype = float)
+    if mode == 1 : base = steps
+    elif mode == 2 : base = radius + 1 - steps
+    else : base = np.ones(radius)
     
-    radius -= exclusion
+    def tables (limit):
+        # cumulative weights for 0 ... radius steps, forward and backward
+        fwd, bwd = np.zeros(radius), np.zeros(radius)
+        for first, last, w1, w2 in line_weights(radius, limit, exclusion):
+            fwd[first - 1 : last] = w1 ; bwd[first - 1 : last] = w2
+        return [np.concatenate([[0], np.cumsum(w * base)]) for w in (fwd, bwd)]
     
-    c1, c2 = np.mgrid[0 : sy, 0 : sx]
+    def counts (rows, cols):
+        # distances to edges, in steps (clipped to radius)
+        i, j = rows[:, None], cols[None, :]
+        dist = {(1, 0) : sy - 1 - i if bottom else radius, 
+                (-1, 0) : i if top else radius,
+                (0, 1) : sx - 1 - j if right else radius,
+                (0, -1) : j if left else radius}
+        
+        def steps_to_edge (dy, dx, table):
+            d = radius
+            if dy : d = np.minimum(d, dist[(dy, 0)])
+            if dx : d = np.minimum(d, dist[(0, dx)])
+            return table[np.clip(d, 0, radius)]
+        
+        cnt = np.zeros((rows.size, cols.size))
+        for dy, dx, weight, limit in lines:
+            t_fwd, t_bwd = tables(limit)
+            fwd, bwd = steps_to_edge(dy, dx, t_fwd), steps_to_edge(-dy, -dx, t_bwd)
+            cnt += weight * (np.maximum(fwd, bwd) if pairs else fwd + bwd)
+        return cnt
     
-    if distance_weighted: 
-        c1, c2 = np.cumsum(c1, axis = 0), np.cumsum(c2, axis=1)
-        max_val = sum([i for i in range(radius + 1)])
-    else: 
-        max_val = radius
-                 
-    c1, c2 = np.clip(c1, 0, max_val ), np.clip(c2, 0, max_val )
+    # regions do not overlap : top and bottom strips span the whole width
+    y0 = min(radius, sy) if top else 0
+    y1 = max(y0, sy - radius) if bottom else sy
+    x0 = min(radius, sx) if left else 0
+    x1 = max(x0, sx - radius) if right else sx
     
-    # reverse and find distances to back edges
-    np.minimum(c1, c1[::-1,:], c1); np.minimum(c2, c2[:, ::-1], c2)
+    regions = []
     
-    # orthogonal mode
-    mx_cnt[:] = c1 + c2 + max_val * 2
+    if y1 > y0 and x1 > x0 : 
+        interior = counts(np.array([radius]), np.array([radius]))[0, 0]
+        regions.append((np.s_[y0 : y1, x0 : x1], interior))
     
-    if diagonals:
-        diag =  c1 + c2 + np.minimum (c1, c2) + max_val 
+    for ys, xs in [(slice(0, y0), slice(0, sx)), (slice(y1, sy), slice(0, sx)),
+                   (slice(y0, y1), slice(0, x0)), (slice(y0, y1), slice(x1, sx))]:
+        if ys.stop > ys.start and xs.stop > xs.start :
+            c = counts(np.arange(ys.start, ys.stop), np.arange(xs.start, xs.stop))
+            c.flags.writeable = False
+            regions.append((np.s_[ys, xs], c))
+    
+    return regions
 
-        mx_cnt += diag / diagonal_weight 
+def normalise_edges (matrix, counts):
+    """
+    Divide matrix (in place) by counts from edge_counts(). 
+    Leading dimensions are treated as bands.
+    """
+    for sl, cnt in counts : matrix[(Ellipsis,) + sl] /= cnt
+    return matrix
+    
+def line_weights (radius, limit = 0, exclusion = 0):
+    """
+    Split the search radius into runs of steps with constant weights. 
+    The limit is the threshold between light and heavy matrix regions
+    (offset TPI), see TPI(). 
+    Returns [(first step, last step, forward weight, backward weight)] 
+    """
+    first = 1 + exclusion
+    
+    if not limit : return [(first, radius, 1, 1)]
     
-    return mx_cnt
+    l = abs(limit)
+    light = radius / (radius + l)
+    last_light = min(int(np.floor(l)), radius)
+    
+    runs = []
+    if last_light >= first : runs.append((first, last_light, light, light))
+    
+    if last_light < radius : # heavy region of the matrix
+        heavy = radius / (radius - l)
+        # swap to change direction
+        w1, w2 = (light, heavy) if limit > 0 else (heavy, light)
+        runs.append((max(first, last_light + 1), radius, w1, w2))
+    
+    return runs
+
+def weighted_line_sums (outs, matrix, dy, dx, mode, radii, 
+                        limit = 0, exclusion = 0, weight = 1):
+    """
+    Add to outs, for each pixel, weighted sums of matrix values found 
+    along (dy, dx) line and in the opposite direction. 
+    Cumulative sums are used, so the cost does not depend on the radius. 
+    Modes are those of TPI, except height weights (which depend on data) : 
+        0 = uniform, 1 = distance weighted, 2 = inverse distance
+    Radii : a list, with one output matrix for each radius 
+    (all are taken from the same cumulative sums). 
+    """
+    flip = dy < 0
+    # cumulative sums run downwards : reverse the line 
+    if flip : dy, dx = -dy, -dx
+    
+    pad = max(radii) + 1 
+    sums = line_prefix(matrix, dy, dx, pad, second_order = mode > 0)
+    
+    for out, radius in zip(outs, radii):
+        for first, last, w1, w2 in line_weights(radius, limit, exclusion):
+            
+            if flip: w1, w2 = w2, w1
+            
+            for backward, w in [(False, w1), (True, w2)]:
+                
+                args = (sums, dy, dx, pad, matrix.shape, first, last)
+                
+                if mode == 0: 
+                    s = line_sum(*args, backward = backward)
+                else: 
+                    s = line_sum(*args, linear = True, backward = backward)
+                    if mode == 2 : # weight = radius + 1 - distance
+                        s *= -1
+                        s += line_sum(*args, backward = backward) * (radius + 1)
+                
+                s *= w * weight
+                out += s
     
 
 def TPI (dem_class, mode, radius, exclude = 0,
-         offset_dist=0, offset_azimuth=0, denoise=None, feedback=None):
+         offset_dist=0, offset_azimuth=0, denoise=None, feedback=None,
+         radii = None, normalise = False):
     """
     Compute Topographic Position Index (TPI) from a DEM.
 
@@ -82,6 +197,13 @@ def TPI (dem_class, mode, radius, exclude = 0,
               2 = median filter
         feedback: object or None, optional
             QGIS-style progress object with .setProgress() and .isCanceled()
+        radii: list of int or None, optional
+            Multi-scale TPI, one output band for each radius (overrides radius). 
+            The output has to be prepared with the same number of bands.
+        normalise: bool, optional
+            Divide by the standard deviation of the neighbourhood 
+            (deviation from mean, DEV). Weighted sums of squares are 
+            accumulated in the same pass.
     """
     
     dem = dem_class
@@ -103,13 +225,23 @@ def TPI (dem_class, mode, radius, exclude = 0,
    # (2w, because heavy + light = 2w)
    # ...need to select light/heavy branches !
     
+    # multi-scale TPI : a band for each radius
+    radii = sorted(set(radii)) if radii else [radius]
+    radius, bands = radii[-1], len(radii)
+    
     overlap = radius if not denoise else radius +1
     
-    chunk_slice = (dem.ysize, dem.chunk_x + 2 * overlap)
+    # keep the memory footprint of all bands close to a single chunk
+    chunk = max(1, dem.chunk_x // bands)
+    
+    chunk_slice = (dem.ysize, chunk + 2 * overlap)
     
     # define empty matrices to hold data : faster
     mx_z = np.zeros( chunk_slice)
-    mx_a = np.zeros(mx_z.shape)
+    # weighted sums for each radius, the last one is used for accumulation
+    mx_a = np.zeros((bands,) + mx_z.shape)
+    # weighted sums of squares, for normalisation
+    mx_a2 = np.zeros(mx_a.shape) if normalise else None
     
         
     # handling irregular pixels (lat long)
@@ -132,17 +264,37 @@ def TPI (dem_class, mode, radius, exclude = 0,
     directions = [(0,1, offset_y),  (1,0, offset_x)] # orthogonal directions 
     if denoise in [1,3]: directions += [(1,1, offset_y_diag), (1, -1, offset_x_diag)]
         
-    precalc = not offset_x and not offset_y and mode in [0,1] # TODO for inverse dist ( mode = 2) !
+    # weights which do not depend on data : use cumulative sums along lines 
+    # (instead of adding each radius step), counts are known in advance
+    prefix_sums = mode in [0, 1, 2]
     
-    if precalc: 
-        mx_cnt =  visits_matrix (mx_z.shape,radius,
-                                diagonals = denoise in [1, 3], 
-                                diagonal_weight = w_diag,
-                                distance_weighted = mode==1,
-                                exclusion = exclude)
-        
+    if prefix_sums : 
+        # counts do not depend on data : see edge_counts()
+        lines = tuple((dy, dx, 1 / w_diag if dx * dy != 0 else (w_x if dx else w_y), limit)
+                      for dx, dy, limit in directions)
     else : 
-        mx_cnt =  np.zeros(mx_z.shape)
+        mx_cnt =  np.zeros(mx_a.shape)
+        
+        # weights for each radius step, in both directions (see line_weights) 
+        step_weights = []
+        for dx, dy, limit in directions:
+            # diagonal distance correction, pixel size correction
+            if dx * dy != 0 : w = 1 / w_diag
+            elif dx : w = w_x 
+            else : w = w_y 
+            # with an offset, weights depend on the radius : a table for each band
+            step_weights.append([{r : (w * w1, w * w2) 
+                                  for first, last, w1, w2 in line_weights(rd, limit, exclude)
+                                  for r in range(first, last + 1)} for rd in radii])
+        
+        # without offset, all radii share the same running sums (snapshots)
+        shared_sums = not any(limit for dx, dy, limit in directions)
+        
+        # scratch matrices for height weights
+        scratch = [np.empty(mx_z.size) for i in range(3 if normalise else 2)]
+    
+    # counts of valid pixels, for chunks with NoData (allocated when needed)
+    mx_valid = None
 
     
     counter = 0
@@ -150,130 +302,1041 @@ def TPI (dem_class, mode, radius, exclude = 0,
     #Loop through data chunks (and write results)
     for mx_view_in, gdal_take, mx_view_out, gdal_put in window_loop ( 
         shape = (dem.xsize, dem.ysize), 
-        chunk = dem.chunk_x,
+        chunk = chunk,
         overlap = overlap) :
         
         mx_z[mx_view_in] = dem.rst.ReadAsArray(*gdal_take).astype(float)
 
         mx_a[:]= 0
-        if not precalc: mx_cnt[:]=0   
+        if not prefix_sums: mx_cnt[:]=0   
+        if normalise : mx_a2[:] = 0
+        
+        # views of all bands
+        a_in = mx_a[(Ellipsis,) + mx_view_in]
         
         # median filter ?? BEFORE OR AFTER ANALYSIS ??
         if denoise == 2 : mx_z = median_filter(mx_z, radius = 3) 
+        
+        z_in = mx_z[mx_view_in]
+        
+        # NoData (NaN) would spread along whole lines with cumulative sums : 
+        # it is set to zero and only valid pixels are counted
+        # (height weights : NaN is kept, affecting only its neighbourhood)
+        nodata = np.isnan(z_in)
+        masked = nodata.any()
+        
+        # TPI does not change with a constant shift : 
+        # this improves precision of cumulative sums (and of squares)
+        if not masked : z_in -= z_in.mean()
+        elif not nodata.all() : z_in -= np.nanmean(z_in)
+        
+        if masked and prefix_sums : 
+            z_in[nodata] = 0
+            valid = (~nodata).astype(float)
+            if mx_valid is None : mx_valid = np.zeros(mx_a.shape)
+            mx_valid[:] = 0
+            valid_in = mx_valid[(Ellipsis,) + mx_view_in]
+        
+        if normalise : a2_in = mx_a2[(Ellipsis,) + mx_view_in]
+        
+        if prefix_sums : 
+            if normalise : zsq_in = z_in ** 2
             
-        for dx, dy, limit in directions:
-
-            for r in range (1 + exclude, radius + 1):     
-                # ! analyse only the supplied data : mx_z[mx_view_in]
-                view_in, view_out = view(r * dy, r * dx, mx_z[mx_view_in].shape)
-                # this is for readability only
-                view_out2, view_in2 = view_in, view_out
-                
-                z, z2 = mx_z[view_in], mx_z[view_in2] 
+            for dx, dy, limit in directions:
                 
-                if mode == 3 : # height diffrence as weight
-                    w = abs (z - z2) 
-                elif  mode == 1:    #'distance_weighted'
-                    w = r
-                elif mode == 2: # inverse dist weighted
-                    w = radius + 1 - r
-                else: w = 1   
+                # diagonal distance correction, pixel size correction
+                if dx * dy != 0 : w = 1 / w_diag
+                elif dx : w = w_x 
+                else : w = w_y 
                 
+                # all radii are read from the same cumulative sums
+                weighted_line_sums(a_in, z_in, dy, dx, 
+                                   mode, radii, limit, exclude, w)
+                if masked : # counts of valid pixels, with the same weights
+                    weighted_line_sums(valid_in, valid, dy, dx, 
+                                       mode, radii, limit, exclude, w)
+                if normalise : 
+                    weighted_line_sums(a2_in, zsq_in, dy, dx, 
+                                       mode, radii, limit, exclude, w)
+                    
+                counter += 1 
+                prog = chunk * (counter/ len(directions)) / dem.xsize
+                feedback.setProgress(100 * prog)
+                if feedback.isCanceled(): return{}
                 
-               # diagonal distance correction
-                if dx * dy != 0 : w /= w_diag
-                elif dx : w *= w_x # pixel size correction
-                else : w *= w_y 
-      
-                
-               # NB - this is very expensive for heights: we can divide the entire DEM, 
-               # but we still need to keep the original for subtraction 
-                                    
-                if limit: # threshold between light and heavy matrix regions
-                    l = abs (limit)
-                    w1 = w * (radius / (radius + l))
-                    if r > l: # heavy region of the matrix
-                        w2 = w * (radius / (radius - l)) 
-                        # swap to change direction
-                        if limit < 0: w2, w1 = w1, w2
-                    else :   w2 = w1 # light region
-                else:  w1, w2 = w, w 
-                                 
-                mx_a[view_out] += z * w1 
-                mx_a[view_out2] += z2 * w2 
+        else : 
+            # height differences as weights (depend on data) 
+            # Sums are made of differences to the central pixel (d), so that 
+            # opposite neighbours share the same products : w * d and w * d**2
+            # running sums are kept in the last band (largest radius), 
+            # smaller radii are copied on the way (shared_sums), 
+            # or they are summed separately, with their own weights
+            sums = [(mx_a[k], mx_cnt[k], mx_a2[k] if normalise else None) 
+                    for k in range(bands)]
+            
+            for r in range (1 + exclude, radius + 1):     
                 
-                if not precalc :
-                    # cannot predict these weights,
-                    # in contrast to constant weights
-                    mx_cnt[view_out] += w1
-                    mx_cnt[view_out2] += w2
+                for (dx, dy, limit), steps in zip(directions, step_weights):
+                    # ! analyse only the supplied data : mx_z[mx_view_in]
+                    view_in, view_out = view(r * dy, r * dx, mx_z[mx_view_in].shape)
+                    # this is for readability only
+                    view_out2, view_in2 = view_in, view_out
                     
-            counter += 1 
-            prog = dem.chunk_x * (counter/ (4 if denoise in [ 1, 3] else 2)) / dem.xsize
-            feedback.setProgress(100 * prog)
-            if feedback.isCanceled(): return{}
+                    z, z2 = mx_z[view_in], mx_z[view_in2] 
+                    
+                    # preallocated scratch matrices, no temporary arrays
+                    # (contiguous : reshaped from flat buffers)
+                    p, w, *p2 = [sc[:z.size].reshape(z.shape) for sc in scratch]
+                    if normalise : p2 = p2[0]
+                    
+                    np.subtract(z, z2, out = p) # neighbour - centre, for view_out
+                    np.abs(p, out = w)
+                    p *= w # weighted difference
+                    if normalise : # weighted squared difference
+                        np.abs(p, out = p2)
+                        p2 *= w
+                    
+                    products = [p, w] + ([p2] if normalise else [])
+                    
+                    # bands summed at this step : the last one (shared sums), 
+                    # or all bands reaching this radius
+                    if shared_sums : bands_r = [bands - 1]
+                    else : bands_r = [k for k in range(bands) if radii[k] >= r]
+                    
+                    f = 1 # current factor of the products
+                    
+                    for k in bands_r: 
+                        run_a, run_cnt, run_a2 = sums[k]
+                        
+                        # w1, w2 : pixel size correction and light/heavy regions (offset)
+                        w1, w2 = steps[k][r]
+                        
+                        if w1 != f : 
+                            for m in products : m *= w1 / f
+                            f = w1
+                        
+                        run_a[view_out] += p
+                        run_cnt[view_out] += w
+                        if normalise : run_a2[view_out] += p2
+                        
+                        # opposite direction : differences change sign
+                        if w2 != f : 
+                            for m in products : m *= w2 / f
+                            f = w2
+                        
+                        run_a[view_out2] -= p
+                        run_cnt[view_out2] += w
+                        if normalise : run_a2[view_out2] += p2
+                
+                if shared_sums and r in radii[:-1]: # snapshot for a smaller radius
+                    k = radii.index(r)
+                    mx_a[k] = mx_a[-1]
+                    mx_cnt[k] = mx_cnt[-1]
+                    if normalise : mx_a2[k] = mx_a2[-1]
+                        
+                counter += 1 
+                prog = chunk * (counter/ (radius - exclude)) / dem.xsize
+                feedback.setProgress(100 * prog)
+                if feedback.isCanceled(): return{}
   
         
-        # this is a patch : the last chunk is often spilling outside raster edge 
-        # so, move the edge values to match raster edge
-        end = gdal_take[2]           
-        if precalc and end + gdal_take[0] == dem.xsize : 
-            mx_cnt[:, end -radius : end] = mx_cnt[ : , -radius : ]
+        if prefix_sums and masked : 
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                a_in /= valid_in
+                if normalise : a2_in /= valid_in
+        
+        elif prefix_sums : 
+            # chunk sides which are raster edges (top and bottom always)
+            edges = (True, True, gdal_take[0] == 0, 
+                     gdal_take[0] + gdal_take[2] == dem.xsize)
+            for k, r in enumerate(radii):
+                cnt = edge_counts(z_in.shape, r, lines, mode, exclude, edges)
+                normalise_edges(a_in[k], cnt)
+                if normalise : normalise_edges(a2_in[k], cnt)
+        else : 
+            mx_a /= mx_cnt
+            if normalise : mx_a2 /= mx_cnt
         
-        mx_z -= mx_a / mx_cnt # weighted mean !
-        out = mx_z
+        # weighted mean ! (of differences to the central pixel, for height weights)
+        mean = mx_a 
+        out = mx_z - mean if prefix_sums else -mean
         
-        dem.add_to_buffer(out[mx_view_out], gdal_put)
+        if normalise : # standard deviation of the neighbourhood
+            out /= np.sqrt(np.maximum(mx_a2 - mean ** 2, 0))
+        
+        if masked : out[(Ellipsis,) + mx_view_in][..., nodata] = np.nan
+        
+        if bands == 1 : out = out[0]
+        
+        dem.add_to_buffer(out[(Ellipsis,) + mx_view_out], gdal_put)
         
     return 1 #should return the file name... 
 
-# TODO FOR SHADOWS
-def shear_matrix_projection(matrix, azimuth, steep, pixel_size, tilt):
+@lru_cache(maxsize = 32)
+def disc_kernel (radius, inner_radius, mode, fft_shape, ratio = 1):
     """
-    Projects a 2D matrix into a sheared space according to azimuth angle.
+    Spectrum of a circular (or annular) TPI neighbourhood, for FFT convolution.
+    - inner_radius : pixels closer than this are excluded (annulus), 
+      the central pixel is always excluded
+    - mode : 0 = uniform, 1 = distance weighted, 2 = inverse distance
+    - fft_shape : padded shape of the data (the kernel is wrapped around the origin)
+    - ratio : pixel height / pixel width, the radius is measured in pixel widths
+    The spectrum is cached : do not modify in place !
+    """
+    ry = int(radius / ratio)
+    y, x = np.ogrid[-ry : ry + 1, -radius : radius + 1]
+    
+    d = np.hypot(y * ratio, x)
+    inside = (d > 0) & (d >= inner_radius) & (d <= radius)
+    
+    if mode == 1 : w = d
+    elif mode == 2 : w = radius + 1 - d
+    else : w = np.ones(d.shape)
+    
+    k = np.zeros(fft_shape)
+    # negative offsets wrap around the matrix end
+    k[y % fft_shape[0], x % fft_shape[1]] = np.where(inside, w, 0)
+    
+    spectrum = fft.rfft2(k)
+    spectrum.flags.writeable = False
+    return spectrum
     
-    Parameters:
-    - matrix: 2D input array (e.g., elevation)
-    - azimuth: direction of light or slope in degrees (0° = North, 90° = East)
-    - steep: if True, apply shearing in the vertical direction; else horizontal
-    - pixel_size: real-world size of one pixel
-    - tilt: scaling factor for projection
-    """
-    H, W = matrix.shape
-
-    # Grid of coordinates
-    y, x = np.meshgrid(np.arange(H), np.arange(W), indexing='ij')
-    coords = np.stack([x.ravel(), y.ravel()], axis=0)  # shape: (2, N)
-
-    # Convert azimuth to radians, relative to image axes (0° = North, 90° = East)
-    azimuth_rad = np.radians(azimuth)
-    dx = np.cos(azimuth_rad)  # x-component of light direction
-    dy = np.sin(azimuth_rad)  # y-component of light direction
-
-    # Build shear matrix based on azimuth and steepness
-    if steep:
-        shear_matrix = np.array([
-            [1, dx],
-            [0, 1]
-        ])
-    else:
-        shear_matrix = np.array([
-            [1, 0],
-            [dy, 1]
-        ])
-
-    # Apply shear transformation
-    sheared_coords = shear_matrix @ coords
-    sheared_x = np.round(sheared_coords[0]).astype(int).reshape(H, W)
-    sheared_y = np.round(sheared_coords[1]).astype(int).reshape(H, W)
-
-    # Calculate projected offset distance
-    distance = (x + y) * pixel_size * np.cos(azimuth_rad) * tilt
-
-    # Preallocate the sheared matrix
-    out_height = sheared_y.max() + 1
-    out_width = sheared_x.max() + 1
-    mx_temp = np.zeros((out_height, out_width))
-
-    return sheared_x, sheared_y, distance, mx_temp
 
+def TPI_disc (dem_class, mode, radius, inner_radius = 0, 
+              denoise = None, feedback = None, radii = None, normalise = False):
+    """
+    TPI over circular or annular neighbourhoods, using FFT convolution.
+    The cost does not depend much on the radius (only on the chunk overlap). 
+    See TPI() for the parameters; denoise can only be a median filter (2 or 3). 
+    Height weighted mode (3) is not possible with convolution.
+    """
+    dem = dem_class
+    
+    radii = sorted(set(radii)) if radii else [radius]
+    radius, bands = radii[-1], len(radii)
+    
+    # the radius is measured in pixel widths
+    ratio = round(dem.pix_y / dem.pix_x, 6)
+    ry = int(radius / ratio)
+    
+    overlap = radius 
+    chunk = max(1, dem.chunk_x // bands)
+    
+    mx_z = np.zeros((dem.ysize, chunk + 2 * overlap))
+    
+    counter = 0
+    
+    for mx_view_in, gdal_take, mx_view_out, gdal_put in window_loop ( 
+        shape = (dem.xsize, dem.ysize), 
+        chunk = chunk,
+        overlap = overlap) :
+        
+        z = mx_z[mx_view_in]
+        z[:] = dem.rst.ReadAsArray(*gdal_take)
+        
+        if denoise in [2, 3] : z = median_filter(z, radius = 3) 
+        
+        # NoData (NaN) would spread over the whole chunk with the FFT : 
+        # it is set to zero, and only valid pixels are counted
+        nodata = np.isnan(z)
+        valid = ~nodata
+        # TPI does not change with a constant shift : better precision
+        z -= np.nanmean(z) if valid.any() else 0
+        z[nodata] = 0
+        
+        sy, sx = z.shape
+        # zero padding, long enough to avoid wrapping around 
+        # (data outside raster edges is not counted)
+        fft_shape = (fft.fast_len(sy + ry), fft.fast_len(sx + radius))
+        
+        # data and counts (valid pixels) share the same transforms, 
+        # squares are needed for normalisation
+        stack = [z, valid.astype(float)] + ([z ** 2] if normalise else [])
+        f = fft.rfft2(np.stack(stack), fft_shape)
+        
+        out = np.empty((bands, sy, sx))
+        
+        for k, r in enumerate(radii):
+            
+            s = fft.irfft2(f * disc_kernel(r, inner_radius, mode, fft_shape, ratio), 
+                              fft_shape)[:, :sy, :sx]
+            
+            # no valid neighbours (rounding errors of the FFT are not zero)
+            s[1][s[1] < 1e-6] = np.nan
+            
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                mean = s[0] / s[1] # weighted mean !
+                out[k] = z - mean
+                
+                if normalise : # standard deviation of the neighbourhood
+                    out[k] /= np.sqrt(np.maximum(s[2] / s[1] - mean ** 2, 0))
+            
+        out[:, nodata] = np.nan
+            
+        if bands == 1 : out = out[0]
+        
+        dem.add_to_buffer(out[(Ellipsis,) + mx_view_out], gdal_put)
+        
+        counter += 1 
+        feedback.setProgress(100 * chunk * counter / dem.xsize)
+        if feedback.isCanceled(): return {}
+    
+    return 1
+
+# ============ HORIZON ANGLES ============
+# Lines searched by the occlusion algorithm (4 axes, 2 directions each).
+# (dy, dx) pairs are used as in OcclusionAlgorithm : view(r * dx, r * dy)
+HORIZON_LINES = [(0,1), (1,0), (1, -1), (1,1)]
+# each line gives two directions, forward (a) and backward (b)
+HORIZON_NAMES = ['S', 'N', 'E', 'W', 'NE', 'SW', 'SE', 'NW']
+HORIZON_AZIMUTHS = [180, 0, 90, 270, 45, 225, 135, 315]
+HORIZON_SCALE = 100 # angles are stored in 1/100 degree (Int16)
+HORIZON_NODATA = -32768
+
+def encode_horizon(tangents):
+    """
+    Convert maximum (or minimum) tangents of a line to Int16 angles (1/100 degree). 
+    Lines without data (infinite values, at raster edges) are set to nodata.
+    """
+    out = np.degrees(np.arctan(tangents)) * HORIZON_SCALE
+    out[~ np.isfinite(tangents)] = HORIZON_NODATA
+    return out
+
+def horizon_products(angles, product, symmetric = False, 
+                     sun_azimuth = 0, sun_angle = 0):
+    """
+    Cheap reductions over a stack of horizon angles (degrees), 
+    in the order of HORIZON_NAMES, with nan for missing lines. 
+    Products : 
+        0 = sky-view (positive angles only)
+        1 = openness 
+        2 = inverted openness (expects minimum angles, i.e. the horizon of inverted DEM)
+        3 = direct sunlight (1 = lit, 0 = in shadow)
+    """
+    if product == 3:
+        # interpolate the horizon between the two closest lines (45° apart)
+        az = np.array(HORIZON_AZIMUTHS)
+        sector = int(sun_azimuth // 45) % 8
+        frac = (sun_azimuth % 45) / 45
+        h1 = angles[np.argmax(az == sector * 45)]
+        h2 = angles[np.argmax(az == ((sector + 1) % 8) * 45)]
+        horizon = h1 * (1 - frac) + h2 * frac
+        # missing lines (raster edges) are considered as open horizon
+        return (np.nan_to_num(horizon, nan = -90) < sun_angle).astype(float)
+    
+    if product == 0: angles = np.clip(angles, 0, None)
+    elif product == 2: angles = -angles
+    
+    if symmetric: # the highest horizon for each pair of opposite lines
+        angles = np.fmax(angles[0::2], angles[1::2])
+    
+    with np.errstate(invalid = 'ignore'): # all lines missing : nan
+        return 1 - np.nanmean(np.sin(np.radians(angles)), axis = 0)
+    
+
+# ============ TEXTURE SHADING ============
+
+@lru_cache(maxsize = 16)
+def texture_filter (fft_shape, alphas, axis = None):
+    """
+    Fractional laplacian filters for real FFT (rfft2) of fft_shape : 
+    H = (fy**2 + fx**2) ** alpha  (alpha = 1 : laplacian filter).
+    With axis : one dimensional filter (f**2) ** alpha, for separable passes
+    along that axis (exact for alpha = 1 only).
+    Alphas is a tuple : filters are stacked in the first dimension.
+    Cached : do not modify !
+    """
+    a = np.array(alphas, dtype = float)[:, np.newaxis, np.newaxis]
+    
+    if axis is None: 
+        fy = np.fft.fftfreq(fft_shape[0])[:, np.newaxis]
+        fx = np.fft.rfftfreq(fft_shape[1])[np.newaxis, :]
+        H = (fy ** 2 + fx ** 2) ** a
+    else : 
+        H = (np.fft.rfftfreq(fft_shape[axis]) ** 2) 
+        H = H[:, np.newaxis] if axis == 0 else H[np.newaxis, :]
+        H = H ** a
+    
+    # single precision : keep spectra of float32 data in complex64
+    H = H.astype(np.float32)
+    
+    H.flags.writeable = False
+    return H
+    
+def texture_tiled (dem_class, alphas, feedback = None, cache = False, halo = 0.25):
+    """
+    Texture shading with 2D FFT over overlapping tiles (overlap-add). 
+    Tiles have a halo of data, tapered to zero (apodized) on its outer part only. 
+    Tile outputs extend over the inner part of the halo, where they are 
+    cross-faded with their neighbours (weights sum to 1) : no seams between tiles.
+    Memory depends on the chunk size, not on the raster.
+    Halo : fraction of the tile side, on each side. This is not exact : 
+    for alpha < 1 the filter reaches beyond the halo (see the help text).
+    The mean elevation is removed, so that the raster is surrounded by 
+    a flat surface (zero padding).
+    With cache, forward spectra are kept on the disk and reused 
+    when only alpha is changed.
+    Multiple alphas are applied to the same forward transform (one band each).
+    """
+    dem = dem_class
+    alphas, bands = tuple(alphas), len(alphas)
+    
+    # tile side, with halo : one chunk of data
+    side = max(4, int(np.sqrt(dem.chunk_size)))
+    halo = max(2, int(side * halo))
+    core = max(1, side - 2 * halo)
+    # cross-fade zone, on each side of the core edges 
+    # (ramps of a tile may not overlap each other)
+    blend = min(halo // 2, core // 2)
+    
+    mx_z = np.zeros((min(core + 2 * halo, dem.ysize), 
+                     min(core + 2 * halo, dem.xsize)), dtype = np.float32)
+    
+    # NoData is replaced by the mean (i.e. zero)
+    mean = dem.mean
+    
+    tiles = list(tile_loop(shape = (dem.xsize, dem.ysize), 
+                           chunk_x = core, chunk_y = core, 
+                           overlap = halo))
+    
+    # zero padding : no wrapping around from opposite edges
+    fft_shapes = [(fft.fast_len(t[1][3] + halo), 
+                   fft.fast_len(t[1][2] + halo)) for t in tiles]
+    
+    key = (cache_key(dem.qrst.source(), '2D overlap-add', side, halo, fft.BACKEND) 
+           if cache else None)
+    if key : 
+        spectra = ArrayCache(key, [(ny, nx // 2 + 1) for ny, nx in fft_shapes], 
+                             dtype = np.complex64, name = 'spectrum')
+    else: spectra = None
+    
+    # No output buffer : tiles are summed in an uncompressed scratch file
+    # (instead of reading back the compressed output), written once at the end.
+    if dem.buffer is None : 
+        partial = scratch(((bands,) if bands > 1 else ()) + (dem.ysize, dem.xsize))
+    else: partial = None
+    
+    for i, (mx_view_in, gdal_take, mx_view_out, gdal_put) in enumerate(tiles): 
+        
+        fft_shape = fft_shapes[i]
+        x_in, y_in, x_in_off, y_in_off = gdal_take
+        x, y, x_off, y_off = gdal_put
+        
+        if spectra and spectra.complete : 
+            r = spectra.get(i)
+        else : 
+            z = dem.take(gdal_take, mx_z[mx_view_in], fill_nodata = mean)
+            z -= mean
+            
+            # taper the outer halo (beyond the cross-fade), except on raster edges
+            z *= taper(y_in_off, halo - blend, y_in > 0, 
+                       y_in + y_in_off < dem.ysize)[:, np.newaxis]
+            z *= taper(x_in_off, halo - blend, x_in > 0, 
+                       x_in + x_in_off < dem.xsize)[np.newaxis, :]
+            
+            r = fft.rfft2(z, fft_shape) 
+            if spectra : spectra.put(i, r)
+        
+        out = fft.irfft2(r * texture_filter(fft_shape, alphas), fft_shape)
+        if bands == 1 : out = out[0]
+        
+        # the core with the cross-fade zones, weighted by ramps over 2 * blend 
+        # (complementary for neighbouring tiles), except on raster edges
+        x0, x1 = max(x - blend, 0), min(x + x_off + blend, dem.xsize)
+        y0, y1 = max(y - blend, 0), min(y + y_off + blend, dem.ysize)
+        
+        out = out[..., y0 - y_in : y1 - y_in, x0 - x_in : x1 - x_in]
+        out *= taper(y1 - y0, 2 * blend, y > 0, y + y_off < dem.ysize)[:, np.newaxis]
+        out *= taper(x1 - x0, 2 * blend, x > 0, x + x_off < dem.xsize)[np.newaxis, :]
+        
+        # the sum goes to the output buffer, or to the scratch file
+        target = dem.buffer if partial is None else partial
+        target[..., y0 : y1, x0 : x1] += out
+        
+        feedback.setProgress(100 * (i + 1) / len(tiles))
+        if feedback.isCanceled(): 
+            if spectra : spectra.discard()
+            return {}
+    
+    if spectra: spectra.close()
+    
+    if partial is None : 
+        dem.write_output()
+    else : 
+        for mx_view_in, gdal_take, mx_view_out, gdal_put in window_loop(
+                shape = (dem.xsize, dem.ysize), 
+                chunk = max(1, dem.chunk_x // bands), axis = 1) :
+            y, y_off = gdal_put[1], gdal_put[3]
+            dem.add_to_buffer(partial[..., y : y + y_off, :], gdal_put)
+    
+    return 1
+
+def texture_separable (dem_class, alphas, feedback = None, cache = False):
+    """
+    Texture shading with 1D FFT passes over rows and columns (full length).
+    Faster, but the fractional laplacian is not separable :
+    the result is only slightly degraded for alpha = 0.5 
+    (and exact for alpha = 1).
+    With cache, forward spectra of both passes are kept on the disk.
+    Multiple alphas are applied to the same forward transform (one band each).
+    
+    The elevation model is read in rows only (column strips are very slow 
+    to read from most rasters) : rows are copied to a scratch file and 
+    transposed by square blocks to a second one, from which columns are read 
+    as contiguous rows. Without output buffer, column results are 
+    transposed back in the same way. Scratch files are thus always 
+    accessed in runs of (at least) a block side, not in scattered values.
+    """
+    dem = dem_class
+    alphas, bands = tuple(alphas), len(alphas)
+    
+    # keep the memory footprint of all bands close to a single chunk
+    chunk_x = max(1, dem.chunk_x // bands)
+    chunk_y = max(1, dem.chunk_y // bands)
+          
+    # define empty matrices to hold data : faster
+    mx_z = np.zeros((chunk_y, dem.xsize), dtype = np.float32)
+    mx_zT = np.zeros((chunk_x, dem.ysize), dtype = np.float32)
+    
+    Ny, Nx = fft_shape = (fft.fast_len(dem.ysize), fft.fast_len(dem.xsize))
+    
+    # filters along rows, and along (transposed) columns
+    Hx = texture_filter(fft_shape, alphas, 1)
+    Hy = texture_filter(fft_shape, alphas, 0).transpose(0, 2, 1)
+    
+    rows = list(window_loop(shape = (dem.xsize, dem.ysize), 
+                            chunk = chunk_y, axis = 1))
+    columns = list(window_loop(shape = (dem.ysize, dem.xsize), 
+                               chunk = chunk_x, axis = 1))
+    
+    key = cache_key(dem.qrst.source(), 'separable', 
+                    chunk_x, chunk_y, fft_shape, fft.BACKEND) if cache else None
+    if key : 
+        spectra_x = ArrayCache(key + 'x', [(chunk_y, Nx // 2 + 1)] * len(rows), 
+                               dtype = np.complex64, name = 'spectrum')
+        spectra_y = ArrayCache(key + 'y', [(chunk_x, Ny // 2 + 1)] * len(columns), 
+                               dtype = np.complex64, name = 'spectrum')
+    else: spectra_x = spectra_y = None
+    
+    # blocks for transposition : one chunk of data (for all bands)
+    side = max(1, int(np.sqrt(dem.chunk_size / bands)))
+    
+    # elevation model, and its transposition (not needed when column spectra are cached)
+    if not (spectra_y and spectra_y.complete) :
+        mx_R = scratch((dem.ysize, dem.xsize))
+        mx_T = scratch((dem.xsize, dem.ysize))
+    
+    # No output buffer : the sum goes to an uncompressed scratch file
+    # (instead of reading back the compressed output), 
+    # the output is written once, with the final sum.
+    # Column results are kept transposed (contiguous rows), and added by blocks.
+    if dem.buffer is None : 
+        b = (bands,) if bands > 1 else ()
+        partial = scratch(b + (dem.ysize, dem.xsize))
+        partial_T = scratch(b + (dem.xsize, dem.ysize))
+    else: partial = None
+    
+    steps = len(rows) * (2 if partial is not None else 1) + len(columns)
+    counter = 0
+    
+    # Break the operation to two axes (x, y) : this works fine for laplacian filter,
+    # but it does not quite work for the *fractional* laplacian (here fraction = alpha)
+    
+    # 1) rows : filter and transpose the data
+    for i, (mx_view_in, gdal_take, mx_view_out, gdal_put) in enumerate(rows):
+        
+        y, y_off = gdal_take[1], gdal_take[3]
+        
+        if not (spectra_x and spectra_x.complete and spectra_y.complete) : 
+            dem.take(gdal_take, mx_z[mx_view_in], fill_nodata = 0)
+            
+            if not (spectra_y and spectra_y.complete) :
+                mx_R[y : y + y_off] = mx_z[:y_off]
+        
+        if spectra_x and spectra_x.complete : 
+            r = spectra_x.get(i)
+        else :
+            r = fft.rfft(mx_z, Nx, axis = 1)
+            if spectra_x : spectra_x.put(i, r)
+        
+        # bands are in the first dimension
+        out = fft.irfft(r * Hx, Nx, axis = 2)[:, :y_off, :dem.xsize]
+        if bands == 1 : out = out[0]
+        
+        if partial is None : 
+            dem.add_to_buffer(out, gdal_put, automatic_save = False)
+        else: partial[..., y : y + y_off, :] = out
+        
+        counter += 1
+        feedback.setProgress(100 * counter / steps)
+        if feedback.isCanceled(): 
+            for spectra in [spectra_x, spectra_y] : 
+                if spectra : spectra.discard()
+            return{}
+    
+    if not (spectra_y and spectra_y.complete) :
+        transpose_blocks(mx_R, mx_T, side)
+        del mx_R
+    
+    # 2) columns, as rows of the transposed data
+    for i, (mx_view_in, gdal_take, mx_view_out, gdal_put) in enumerate(columns):
+        
+        x, x_off = gdal_take[1], gdal_take[3]
+        
+        if spectra_y and spectra_y.complete : 
+            r = spectra_y.get(i)
+        else :
+            mx_zT[:x_off] = mx_T[x : x + x_off]
+            r = fft.rfft(mx_zT, Ny, axis = 1)
+            if spectra_y : spectra_y.put(i, r)
+        
+        out = fft.irfft(r * Hy, Ny, axis = 2)[:, :x_off, :dem.ysize]
+        if bands == 1 : out = out[0]
+        
+        if partial is None : 
+            dem.buffer[..., :, x : x + x_off] += out.swapaxes(-1, -2)
+        else: partial_T[..., x : x + x_off, :] = out
+        
+        counter += 1
+        feedback.setProgress(100 * counter / steps)
+        if feedback.isCanceled(): 
+            for spectra in [spectra_x, spectra_y] : 
+                if spectra : spectra.discard()
+            return{}
+    
+    for spectra in [spectra_x, spectra_y] : 
+        if spectra : spectra.close()
+    
+    # 3) save the result (by rows)
+    if partial is None : 
+        dem.write_output()
+    else : 
+        transpose_blocks(partial_T, partial, side, add = True)
+        del partial_T
+        
+        for mx_view_in, gdal_take, mx_view_out, gdal_put in rows :
+            y, y_off = gdal_put[1], gdal_put[3]
+            dem.add_to_buffer(partial[..., y : y + y_off, :], gdal_put)
+            
+            counter += 1
+            feedback.setProgress(100 * counter / steps)
+            if feedback.isCanceled(): return{}
+    
+    return 1
+    
+
+# ============ SHADOWS ============
+
+def shadow_traversal (direction):
+    """
+    Order of traversal for sun direction (in degrees, on the pixel grid) :
+    data is read in lines going away from the sun. 
+    Returns (steep, reverse, flip, slope) : 
+    - steep : lines run along rows (sun from the east or west), 
+              i.e. the data is read in columns ;
+    - reverse : data is read back to front (from the right or from the bottom) ;
+    - flip : lines are shifted towards lower indices ;
+    - slope : shift across lines, for each step (0 - 1 pixel).
+    """
+    a = np.radians(direction)
+    # light travels away from the sun : on the grid (rows down, columns right)
+    dy, dx = np.cos(a), -np.sin(a)
+    
+    steep = abs(dx) >= abs(dy)
+    
+    if steep : step, across = dx, dy
+    else : step, across = dy, dx
+    
+    return steep, step < 0, across < 0, abs(across / step)
+
+def shadow_distance (dem_class, direction, y, x, dtype = float):
+    """
+    Horizontal distance in the direction of light, for raster rows y 
+    and columns x (1D arrays), as an (y, x) matrix. 
+    The origin is arbitrary, but common to all chunks.
+    """
+    a = np.radians(direction)
+    dy = (y * dem_class.pix_y * np.cos(a)).astype(dtype)
+    dx = (x * dem_class.pix_x * np.sin(a)).astype(dtype)
+    return dy[:, np.newaxis] - dx[np.newaxis, :]
+
+def shadow_frame (matrix, steep, reverse, flip):
+    """
+    View of a data chunk where lines of light run along the first axis 
+    (towards higher indices) and are shifted towards higher indices on the second.
+    """
+    if steep : matrix = matrix.T
+    if reverse : matrix = matrix[::-1]
+    if flip : matrix = matrix[:, ::-1]
+    return matrix
+
+def shear_shifts (start, n, slope):
+    """
+    Shift across lines of light for n steps from start (rounded) : 
+    digital lines over the whole raster.
+    """
+    return np.floor(np.arange(start, start + n) * slope + 0.5).astype(int)
+
+def shadow_kernel (mx_v, mx_out, start, slope, last_line, lines = None):
+    """
+    Shadow depth for a chunk in the traversal frame (see shadow_frame). 
+    mx_v holds elevations raised by the distance from the sun (z + d * tilt); 
+    the deepest shadow is the difference to the highest value met 
+    along the line of light. 
+    Lines are sheared on the fly : consecutive steps with the same shift 
+    are a plain accumulation over the carried values (no index maps 
+    nor sheared copies of the data).
+    - start : position of the first row in the whole traversal (step number),
+    - last_line : the highest values on each line, carried from the previous 
+      chunk (updated in place). Lines are numbered from the end of the raster, 
+      so the numbering is the same for all chunks.
+    - lines : (first, last) line numbers, to process a band of lines only.
+      Lines are independent : bands can run in parallel.
+    """
+    n, m = mx_v.shape
+    
+    shift = shear_shifts(start, n, slope)
+    
+    # total shift (at the end of the raster)
+    end = last_line.size - m
+    
+    first, last = lines if lines else (0, last_line.size)
+    
+    # runs of steps with the same shift
+    breaks = np.flatnonzero(np.diff(shift)) + 1
+    
+    for a, b in zip(np.r_[0, breaks], np.r_[breaks, n]):
+        
+        # line number of the first pixel in the run
+        lo = end - shift[a]
+        
+        # pixels on the lines of the band
+        j0, j1 = min(max(first - lo, 0), m), min(max(last - lo, 0), m)
+        if j0 == j1 : continue
+        
+        line = last_line[lo + j0 : lo + j1]
+        
+        # the output is used for the running maximum
+        acc = mx_out[a : b, j0 : j1]
+        np.maximum.accumulate(mx_v[a : b, j0 : j1], axis = 0, out = acc)
+        np.maximum(acc, line, out = acc)
+        
+        line[:] = acc[-1]
+        
+        np.subtract(mx_v[a : b, j0 : j1], acc, out = acc)
+    
+def shadow_chunks (dem_class, positions, smooth = False, threads = 1, 
+                   dtype = np.float64):
+    """
+    Shadow depth for a series of sun positions [(direction, sun angle), ...], 
+    by chunks : yields (index of position, shadow depth, gdal_put, progress). 
+    Positions requiring the same order of reading share the input data 
+    (each chunk is read once for all), and sun angles of the same direction 
+    share distances along the light. Progress goes from 0 to 1. 
+    Threads : lines of light are split in bands, processed in parallel
+    (0 : all processors).
+    dtype : precision of working data (np.float32 takes half the memory, 
+    with errors in the order of 1e-7 * the distance across the raster * tan(sun angle)).
+    """
+    dem = dem_class
+    
+    threads = threads or os.cpu_count() or 1
+    pool = ThreadPoolExecutor(threads) if threads > 1 else None
+    
+    # group positions by traversal (order of reading)
+    groups = {}
+    for i, (direction, sun_angle) in enumerate(positions):
+        
+        # Fixing WGS bias : rectangular pixels 
+        # for instance, 45° is no longer a simple diagonal
+        grid_direction = (dem.angle_adjustment(direction) 
+                          if dem.pix_x != dem.pix_y else direction)
+        
+        steep, reverse, flip, slope = shadow_traversal(grid_direction)
+        
+        groups.setdefault((steep, reverse), []).append(
+            (i, direction, dtype(np.tan(np.radians(sun_angle))), flip, slope))
+    
+    total = len(positions) 
+    counter = 0
+    
+    try : 
+        for (steep, reverse), group in groups.items():
+            
+            # length of the traversal, and of the lines across
+            steps, across = (dem.xsize, dem.ysize) if steep else (dem.ysize, dem.xsize)
+            
+            # keep the memory footprint of all positions close to a single chunk
+            chunk = max(1, min(dem.chunk_y if steep else dem.chunk_x, steps) // len(group))
+            
+            last_lines = [np.full(across + shear_shifts(steps - 1, 1, slope)[0], 
+                                  -np.inf, dtype = dtype) 
+                          for i, direction, tilt, flip, slope in group]
+            # last line of the previous chunk, for smoothing
+            prev_lines = {i : None for i, *_ in group}
+            
+            chunk_slice = (dem.ysize, chunk) if steep else (chunk, dem.xsize)
+            mx_z = np.zeros(chunk_slice, dtype = dtype)
+            
+            for mx_view_in, gdal_take, mx_view_out, gdal_put in window_loop ( 
+                shape = (dem.xsize, dem.ysize), 
+                chunk = chunk,
+                axis = not steep, 
+                reverse = reverse) :
+                
+                x, y, x_off, y_off = gdal_take
+                
+                z = dem.take(gdal_take, mx_z[mx_view_in], fill_nodata = np.nan)
+                mask = np.isnan(z)
+                
+                # position of the first line (in the order of reading)
+                if steep : start, n = (dem.xsize - x - x_off if reverse else x), x_off
+                else : start, n = (dem.ysize - y - y_off if reverse else y), y_off
+                
+                # smoothing halo : the first line of the next chunk 
+                # (the last line of the previous one is kept from the last pass)
+                z_next = None
+                if smooth and start + n < steps : 
+                    if steep : 
+                        take_next = (x - 1 if reverse else x + x_off, 0, 1, dem.ysize)
+                    else : 
+                        take_next = (0, y - 1 if reverse else y + y_off, dem.xsize, 1)
+                    xn, yn, xn_off, yn_off = take_next
+                    z_next = dem.take(take_next, 
+                                      np.zeros((yn_off, xn_off), dtype = dtype), 
+                                      fill_nodata = np.nan)
+                    mask_next = np.isnan(z_next)
+                
+                # distances along the light, shared by all sun angles of a direction
+                distances = {}
+                
+                for (i, direction, tilt, flip, slope), last_line in zip(group, last_lines):
+                    
+                    if direction not in distances :
+                        distances[direction] = shadow_distance(
+                            dem, direction, np.arange(y, y + y_off), 
+                            np.arange(x, x + x_off), dtype = dtype)
+                    
+                    v = z + tilt * distances[direction]
+                    # nans would destroy the accumulation sequence
+                    v[mask] = -np.inf
+                    
+                    out = np.empty(v.shape, dtype = dtype)
+                    
+                    args = (shadow_frame(v, steep, reverse, flip), 
+                            shadow_frame(out, steep, reverse, flip), 
+                            start, slope, last_line)
+                    
+                    if pool : 
+                        size = -(-last_line.size // threads)
+                        bands = [(l, l + size) for l in range(0, last_line.size, size)]
+                        # list() : wait for all, and raise errors
+                        list(pool.map(lambda lines: shadow_kernel(*args, lines), bands))
+                    else : shadow_kernel(*args)
+                    
+                    if smooth: 
+                        out[mask] = 0
+                        
+                        # a 3x3 filter is the same in the traversal frame
+                        frame = [shadow_frame(out, steep, reverse, flip)]
+                        
+                        if prev_lines[i] is not None : frame.insert(0, prev_lines[i])
+                        
+                        if z_next is not None : 
+                            v_next = z_next + tilt * shadow_distance(
+                                dem, direction, np.arange(yn, yn + yn_off), 
+                                np.arange(xn, xn + xn_off), dtype = dtype)
+                            v_next[mask_next] = -np.inf
+                            
+                            out_next = np.empty(v_next.shape, dtype = dtype)
+                            # a copy : the carried values are for the next chunk
+                            shadow_kernel(shadow_frame(v_next, steep, reverse, flip), 
+                                          shadow_frame(out_next, steep, reverse, flip), 
+                                          start + n, slope, 
+                                          last_line.copy())
+                            out_next[mask_next] = 0
+                            frame.append(shadow_frame(out_next, steep, reverse, flip))
+                        
+                        smoothed = filter3(np.concatenate(frame))
+                        
+                        core = 0 if prev_lines[i] is None else 1
+                        view = frame[core]
+                        prev_lines[i] = view[-1:].copy()
+                        view[:] = smoothed[core : core + n]
+                    
+                    #remove noData shadows    
+                    out[mask] = np.nan
+                    
+                    counter += chunk / steps
+                    yield i, out, gdal_put, min(counter / total, 1)
+    finally :
+        if pool : pool.shutdown()
+    
+def shadow_depth (dem_class, positions, smooth = True, 
+                  feedback = None, threads = 1, dtype = np.float64):
+    """
+    Shadow depth : the depth below the shadow line cast by the terrain 
+    between each pixel and the sun (negative values, zero for lit pixels). 
+    Each sun position [(direction, sun angle), ...] is written to a separate band. 
+    """
+    dem = dem_class
+    
+    for band, out, gdal_put, progress in shadow_chunks(
+            dem, positions, smooth = smooth, threads = threads, dtype = dtype):
+        
+        # auto save - doesn't work with reverse reading
+        dem.add_to_buffer(out, gdal_put, automatic_save = False, band = band)
+        
+        feedback.setProgress(100 * progress)
+        if feedback.isCanceled(): return {}
+    
+    dem.write_output()
+    
+    return 1
+
+def surface_normal (dem_class, gdal_put):
+    """
+    Unit normal vectors (east, north, up) for a chunk of the raster. 
+    The chunk is read with a margin of one pixel, for gradients.
+    """
+    dem = dem_class
+    x, y, x_off, y_off = gdal_put
+    
+    x0, y0 = max(x - 1, 0), max(y - 1, 0)
+    x1, y1 = min(x + x_off + 1, dem.xsize), min(y + y_off + 1, dem.ysize)
+    
+    z = dem.take((x0, y0, x1 - x0, y1 - y0), np.zeros((y1 - y0, x1 - x0)))
+    
+    # np.gradient needs two pixels
+    dz_y = np.gradient(z, axis = 0) if z.shape[0] > 1 else np.zeros(z.shape)
+    dz_x = np.gradient(z, axis = 1) if z.shape[1] > 1 else np.zeros(z.shape)
+    
+    core = np.s_[y - y0 : y - y0 + y_off, x - x0 : x - x0 + x_off]
+    
+    # rows go southwards
+    n = np.stack([-dz_x[core] / dem.pix_x, dz_y[core] / dem.pix_y, 
+                  np.ones((y_off, x_off))])
+    n /= np.sqrt(np.sum(n ** 2, axis = 0))
+    return n
+
+def sun_positions (latitude, first_day, last_day, step = 30):
+    """
+    Sun positions [(azimuth, elevation), ...] in degrees, above the horizon, 
+    for days of year from first_day to last_day (inclusive), 
+    every step minutes of solar time. 
+    Simple astronomical model : declination from the day of year, 
+    no equation of time nor refraction.
+    """
+    if last_day < first_day : last_day += 365 # over the new year
+    
+    days = np.arange(first_day, last_day + 1)
+    hours = np.arange(step / 2, 24 * 60, step) / 60 
+    
+    d = np.radians(-23.44 * np.cos(np.radians(360 / 365 * (days + 10))))[:, np.newaxis]
+    h = np.radians(15 * (hours - 12))[np.newaxis, :]
+    lat = np.radians(latitude)
+    
+    e = np.arcsin(np.sin(lat) * np.sin(d) + np.cos(lat) * np.cos(d) * np.cos(h))
+    a = np.arctan2(np.sin(h), np.cos(h) * np.sin(lat) - np.tan(d) * np.cos(lat))
+    
+    a, e = np.degrees(a).ravel() + 180, np.degrees(e).ravel()
+    
+    return [(a, e) for a, e in zip(a[e > 0], e[e > 0])]
+
+def insolation (dem_class, positions, weights, mode = 0, 
+                feedback = None, threads = 1, dtype = np.float64):
+    """
+    Shadows cast over a series of sun positions [(direction, sun angle), ...] :
+    - mode 0 : sum of weights (e.g. hours) for positions where pixels are shaded,
+    - mode 1 : relative insolation, the sum of weights * cosine of incidence angle
+      for lit pixels, divided by the same sum for an open, flat surface.
+    Shadows are added to a single buffer : no intermediate results are saved.
+    """
+    dem = dem_class
+    
+    # unbuffered output : sum in a scratch file (not reading back the output)
+    total = dem.buffer if dem.buffer is not None else scratch((dem.ysize, dem.xsize))
+    total[:] = 0
+    
+    normal, last_put = None, None
+    
+    for i, out, gdal_put, progress in shadow_chunks(
+            dem, positions, threads = threads, dtype = dtype):
+        
+        x, y, x_off, y_off = gdal_put
+        view = total[y : y + y_off, x : x + x_off]
+        
+        if mode == 0 :
+            view += weights[i] * (out < 0)
+        else : 
+            # surface normals are shared by all positions of the chunk
+            if gdal_put != last_put :
+                normal, last_put = surface_normal(dem, gdal_put), gdal_put
+            
+            a, e = np.radians(positions[i])
+            sun = np.array([np.cos(e) * np.sin(a), np.cos(e) * np.cos(a), np.sin(e)])
+            
+            cos_i = np.tensordot(sun, normal, axes = 1)
+            view += weights[i] * np.where(out < 0, 0, np.maximum(cos_i, 0))
+        
+        view[np.isnan(out)] = np.nan
+        
+        feedback.setProgress(100 * progress)
+        if feedback.isCanceled(): return {}
+    
+    if mode == 1 : 
+        total /= sum(w * np.sin(np.radians(e)) for (a, e), w in zip(positions, weights))
+    
+    if dem.buffer is None : 
+        # copy the scratch file to the output, by rows
+        for mx_view_in, gdal_take, mx_view_out, gdal_put in window_loop ( 
+                shape = (dem.xsize, dem.ysize), chunk = dem.chunk_y, axis = 1):
+            y, y_off = gdal_put[1], gdal_put[3]
+            dem.add_to_buffer(np.array(total[y : y + y_off]), gdal_put, 
+                              automatic_save = False)
+    
+    dem.write_output()
+    
+    return 1
+
+
+# ============ HILLSHADE ============
+
+def hillshade_kernel (out, lon_z, lat_z, sun_angle, lon_factor, lat_factor, 
+                      weight = 1, bidirectional = False, scratch = None):
+    """
+    Lambertian reflectance from slopes along the light (lon_z) and across (lat_z), 
+    added to out (multiplied by weight). 
+    cos(arctan(x) - s) * cos(arctan(y)) is computed algebraically, as 
+    (cos(s) + x * sin(s)) / sqrt((1 + x²) * (1 + y²)), with no angles nor temporary arrays.
+    Bidirectional : the hillshade from the perpendicular direction is added 
+    (slopes are swapped, with their factors).
+    Scratch : two arrays with the shape of the data (allocated if None).
+    """
+    t, u = scratch if scratch is not None else (np.empty(out.shape), np.empty(out.shape))
+    
+    cs, ss = np.cos(sun_angle), np.sin(sun_angle)
+    
+    shades = [(lon_z, lat_z, 1)]
+    # accessory direction : lon = -lat, lat = lon
+    if bidirectional: shades.append((lat_z, lon_z, -1))
+    
+    for x, y, sign in shades:
+        
+        # u = sqrt((1 + x²) * (1 + y²))
+        np.multiply(x, lon_factor, out = u)
+        np.square(u, out = u)
+        u += 1
+        np.multiply(y, lat_factor, out = t)
+        np.square(t, out = t)
+        t += 1
+        u *= t
+        np.sqrt(u, out = u)
+        
+        # t = cos(s) + x * sin(s)
+        np.multiply(x, sign * lon_factor * ss, out = t)
+        t += cs
+        
+        t /= u
+        if weight != 1 : t *= weight
+        out += t
@@ -49,6 +49,8 @@ except ImportError:
 import numpy as np
 from .modules import Raster as rs
 from .modules.helpers import view, window_loop, filter3, median_filter
+from .modules.shaders import (HORIZON_LINES, HORIZON_NAMES, HORIZON_NODATA,
+                              encode_horizon, edge_counts, normalise_edges)
 from qgis.core import QgsMessageLog # for testing
 class OcclusionAlgorithm(QgsProcessingAlgorithm):
     """
@@ -64,7 +66,10 @@ class OcclusionAlgorithm(QgsProcessingAlgorithm):
     ANALYSIS_TYPE='ANALYSIS_TYPE'
     SYMMETRIC='SYMMETRIC'
     #RANGE = 'RANGE'
+    HORIZON_DISTANCE = 'HORIZON_DISTANCE'
+    HORIZON_MINIMUM = 'HORIZON_MINIMUM'
     OUTPUT = 'OUTPUT'
+    HORIZONS = 'HORIZONS'
     ANALYSIS_TYPES = ['Sky-view','Openness']
     DENOISE_TYPES= ['None', 'Mean', 'Median', 'Mean and median']
     output_model = None #for post-processing
@@ -112,11 +117,27 @@ class OcclusionAlgorithm(QgsProcessingAlgorithm):
             self.DENOISE_TYPES,
             defaultValue=0)) 
         
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.HORIZON_DISTANCE,
+            self.tr('Horizon angles: add distances'),
+            False, False)) 
+        
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.HORIZON_MINIMUM,
+            self.tr('Horizon angles: add minimum angles'),
+            False, False)) 
+        
         self.addParameter(
             QgsProcessingParameterRasterDestination(
                 self.OUTPUT,
             self.tr("Ambient occlusion")))
         
+        self.addParameter(
+            QgsProcessingParameterRasterDestination(
+                self.HORIZONS,
+            self.tr("Horizon angles"), 
+            optional = True, createByDefault = False))
+        
     def processAlgorithm(self, parameters, context, feedback):
         """
         Here is where the processing itself takes place.
@@ -139,36 +160,54 @@ class OcclusionAlgorithm(QgsProcessingAlgorithm):
         # STILL TESTING
         difference = None #self.parameterAsInt(parameters,self.RANGE, context)
         
+        horizons = self.parameterAsOutputLayer(parameters,self.HORIZONS,context)
+        distances = self.parameterAsInt(parameters,self.HORIZON_DISTANCE, context)
+        minima = self.parameterAsInt(parameters,self.HORIZON_MINIMUM, context)
+        
         dem = rs.Raster(elevation_model)
         
         err, fatal = dem.verify_raster()
         if err: feedback.reportError(err, fatalError = fatal)
 
         dem.set_output(self.output_model)
+        
+        if horizons : 
+            # a second handle for the horizon cube : 
+            # Int16 bands, angles in 1/100 degree, distances in pixels (steps along the line)
+            names = ['horizon_' + n for n in HORIZON_NAMES]
+            if distances : names += ['distance_' + n for n in HORIZON_NAMES]
+            if minima : names += ['minimum_' + n for n in HORIZON_NAMES]
+            
+            cube = rs.Raster(elevation_model)
+            cube.set_output(horizons, no_data = HORIZON_NODATA,
+                            data_format_override = rs.INT,
+                            bands = len(names), band_names = names,
+                            rescale = False)
                                
         overlap = radius if not denoise else radius +1
              
         chunk_slice = (dem.ysize, dem.chunk_x + 2 * overlap)
                         
         mx_z = np.zeros(chunk_slice)
+        
+        # running maximum angles (a : forward, b : backward direction)
         mx_a = np.zeros(mx_z.shape)
-      
-        if symmetric: mx_b = mx_a
-        else: mx_b = np.zeros(mx_z.shape)
+        mx_b = np.zeros(mx_z.shape)
         
-        mx_a = np.zeros(mx_z.shape + ((radius ,) ))
-        mx_b = np.zeros(mx_z.shape + ((radius ,) ))
+        if minima or difference:
+            mn_a, mn_b = np.zeros(mx_z.shape), np.zeros(mx_z.shape)
+        
+        if horizons: 
+            mx_h = np.zeros((len(names),) + mx_z.shape)
+            # band positions for distances and minima
+            pos_d = len(HORIZON_NAMES)
+            pos_m = pos_d * (2 if distances else 1)
         
         out =  np.zeros(mx_z.shape)
                 
-        # intialise the count of lines per pixel
-        mx_cnt = np.ones(mx_z.shape)
-        # set borders first  
-        mx_cnt[:]= 5 if not symmetric else 3
-        # main area : 8 lines per pixel (or 4 if symmetric algo)
-        mx_cnt[1:-1, 1:-1] = 8 if not symmetric else 4
-        # corners
-        for v in [(0,0),(-1,-1),(0,-1), (-1,0)]: mx_cnt[v] = 3
+        # count of lines per pixel : 8 lines (or 4 pairs if symmetric algo), 
+        # minus those beyond raster edges
+        lines = tuple((dx, dy, 1, 0) for dy, dx in HORIZON_LINES)
                
         counter = 0
             
@@ -190,11 +229,19 @@ class OcclusionAlgorithm(QgsProcessingAlgorithm):
             
 
             # 8 standard lines, we use symmetry to optimise
-            for dy, dx in [(0,1), (1,0), (1, -1), (1,1)]:
+            for i, (dy, dx) in enumerate(HORIZON_LINES):
                 
                 if dx * dy : pix = np.sqrt( dem.pix_y**2 + dem.pix_x**2)
                 else : pix = dem.pix_y if dx else dem.pix_x #swapped x, y
                 
+                # clean-up, remove old values 
+                # (-inf : no data along the line, i.e. beyond raster edges)
+                mx_a[:] = -np.inf ; mx_b[:] = -np.inf 
+                if minima or difference: mn_a[:] = np.inf ; mn_b[:] = np.inf
+                if horizons and distances: 
+                    d_a, d_b = mx_h[pos_d + 2 * i], mx_h[pos_d + 2 * i + 1]
+                    d_a[:] = HORIZON_NODATA ; d_b[:] = HORIZON_NODATA
+                
                 for r in range (1, radius + 1): 
                     # we could probably sample over radius, not all pixels are needed...
                                                  
@@ -205,52 +252,75 @@ class OcclusionAlgorithm(QgsProcessingAlgorithm):
                     dist = r * pix
                     
                     angles /= dist 
+                    
+                    # keep running maxima, instead of storing all angles
+                    a, b = mx_a[view_out], mx_b[view_in]
+                    
+                    if horizons and distances: 
+                        d_a[view_out][angles > a] = r
+                        d_b[view_in][-angles > b] = r
      
-                    mx_a[view_out][:,:,r-1] = angles
-                    mx_b[view_in][:,:,r-1] = -angles
+                    np.maximum(a, angles, out = a)
+                    np.maximum(b, -angles, out = b)
+                    
+                    if minima or difference:
+                        a, b = mn_a[view_out], mn_b[view_in]
+                        np.minimum(a, angles, out = a)
+                        np.minimum(b, -angles, out = b)
                     
                     # a patch for irregular pixels : take care of the length of the LOS
                     if dist > min(dem.pix_x * radius, dem.pix_y * radius) : break
-               
+                
+                if horizons: 
+                    mx_h[2 * i] = encode_horizon(mx_a)
+                    mx_h[2 * i + 1] = encode_horizon(mx_b)
+                    if minima:
+                        mx_h[pos_m + 2 * i] = encode_horizon(mn_a)
+                        mx_h[pos_m + 2 * i + 1] = encode_horizon(mn_b)
+                    
+                # no data along the line : nan, no contribution 
+                # (as in horizon_products)
+                mx_a[np.isneginf(mx_a)] = np.nan ; mx_b[np.isneginf(mx_b)] = np.nan
+                
                 if not openness:  # sky view factor - remove negative angles
-                    mx_a [mx_a < 0] = 0; mx_b[mx_b < 0] = 0
+                    np.maximum(mx_a, 0, out = mx_a); np.maximum(mx_b, 0, out = mx_b)
                  
-                max_a = np.max(mx_a, axis = 2)
-                max_b = np.max(mx_b, axis = 2)
+                max_a, max_b = mx_a, mx_b
                 
                 if difference : 
-                    max_a -= np.min(mx_a, axis = 2)
-                    max_b -= np.min(mx_b, axis = 2)
+                    max_a -= mn_a
+                    max_b -= mn_b
                               
                 # average of angles: see Kokalj et al. 2011
                 # these operations are costly, however ...
                 if symmetric : 
-                    # find the highest angle for each *pair* of LOS
-                    np.maximum(max_a, max_b, out=max_a)
-                    out += np.sin(np.arctan(max_a) )
+                    # find the highest angle for each *pair* of LOS 
+                    # (a missing line does not count)
+                    np.fmax(max_a, max_b, out=max_a)
+                    out += np.nan_to_num(np.sin(np.arctan(max_a)))
                 else: 
-                    out += np.sin(np.arctan(max_a)) 
-                    out += np.sin(np.arctan(max_b)) 
-                
-                mx_a[:] = 0 ; mx_b[:] = 0 # clean-up, remove old values 
+                    out += np.nan_to_num(np.sin(np.arctan(max_a))) 
+                    out += np.nan_to_num(np.sin(np.arctan(max_b))) 
 
                 counter += 1
                 
                 feedback.setProgress(100 * dem.chunk_x * (counter/4) /  dem.xsize)
                 if feedback.isCanceled(): return {}
             
-            # this is a patch : last chunk is often spilling outside raster edge 
-            # so, move the edge values to match raster edge
-            end = gdal_take[2]           
-            if end + gdal_take[0] == dem.xsize : 
-                mx_cnt[:, end-1: end] = mx_cnt[:, -1:] 
+            # chunk sides which are raster edges (top and bottom always)
+            edges = (True, True, gdal_take[0] == 0, 
+                     gdal_take[0] + gdal_take[2] == dem.xsize)
             
-            out /= mx_cnt
+            normalise_edges(out[mx_view_in], 
+                            edge_counts(out[mx_view_in].shape, 1, lines, 
+                                        edges = edges, pairs = symmetric))
             out = 1 - out
 
             dem.add_to_buffer(out[mx_view_out], gdal_put)
             
-        return {self.OUTPUT: self.output_model}
+            if horizons : cube.add_to_buffer(mx_h[(Ellipsis,) + mx_view_out], gdal_put)
+            
+        return {self.OUTPUT: self.output_model, self.HORIZONS: horizons}
 
     def postProcessAlgorithm(self, context, feedback):
 
@@ -305,6 +375,7 @@ class OcclusionAlgorithm(QgsProcessingAlgorithm):
                  - Inverted DEM: Invert high and low values (multiply the DEM by -1) 
                  - Radius: The ambient occlusion is calculated within a defined radius for each raster pixel (computation time is directly dependent on the analysis radius).
                  - Denoise: Apply a smoothing filter.
+                 - Horizon angles (optional): save maximum horizon angles for each of the 8 search directions (multiband raster, Int16 in 1/100 degree), optionally with distances (in pixels) and minimum angles. Sky-view, openness or direct sunlight can then be derived without a new search, see Horizon products algorithm. 
                 NB. This algorithm is made for terrain visualisation, it is not appropriate for precise calculation of solar exposition or of incident light.
                 For more information, check <a href = "https://landscapearchaeology.org/qgis-terrain-shading/" >the manual</a>.
              
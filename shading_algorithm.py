@@ -35,13 +35,12 @@ except ImportError: from PyQt6.QtCore import QCoreApplication
 from qgis.core import (QgsProcessing,
                        QgsProcessingException,
                        QgsProcessingAlgorithm,
-                       QgsProcessingMultiStepFeedback,
                        QgsProcessingParameterRasterLayer,
                        QgsProcessingParameterRasterDestination,
                         QgsProcessingParameterBoolean,
                       QgsProcessingParameterNumber,
                        QgsProcessingParameterEnum,
-
+                       QgsProcessingParameterString,
                        QgsProcessingUtils,
                        QgsRasterBandStats
                         )
@@ -54,7 +53,8 @@ except ImportError:
 
 import numpy as np
 from .modules import Raster as rs
-from .modules.helpers import window_loop, filter3
+from .modules.helpers import parse_list
+from .modules.shaders import shadow_depth
 
 class DemShadingAlgorithm(QgsProcessingAlgorithm):
     """
@@ -67,7 +67,10 @@ class DemShadingAlgorithm(QgsProcessingAlgorithm):
 
     INPUT = 'INPUT'
     DIRECTION= 'DIRECTION'
+    DIRECTIONS = 'DIRECTIONS'
     ANGLE= 'ANGLE'
+    ANGLES = 'ANGLES'
+    FRAMES = 'FRAMES'
     SMOOTH = 'SMOOTH'
    # ANALYSIS_TYPE='ANALYSIS_TYPE'
     OUTPUT = 'OUTPUT'
@@ -95,12 +98,27 @@ class DemShadingAlgorithm(QgsProcessingAlgorithm):
             self.tr('Sun direction (0 to 360°)'),
             QgsProcessingParameterNumber.Integer,
             defaultValue = 315, minValue= 0, maxValue= 360))
+        
+        self.addParameter(QgsProcessingParameterString(
+            self.DIRECTIONS,
+            self.tr('Multiple sun directions (comma separated or start:stop:step, overrides direction)'),
+            optional = True))
             
         self.addParameter(QgsProcessingParameterNumber(
             self.ANGLE,
             self.tr('Sun angle'),
             QgsProcessingParameterNumber.Double,
             defaultValue = 10, minValue= 0, maxValue= 89))
+        
+        self.addParameter(QgsProcessingParameterString(
+            self.ANGLES,
+            self.tr('Multiple sun angles (comma separated or start:stop:step, overrides sun angle)'),
+            optional = True))
+        
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.FRAMES,
+            self.tr('Animation frames (pair directions and angles, in order)'),
+            False, True)) 
 
         self.addParameter(QgsProcessingParameterBoolean(
             self.SMOOTH,
@@ -117,8 +135,6 @@ class DemShadingAlgorithm(QgsProcessingAlgorithm):
         Here is where the processing itself takes place.
         """
 
-        feedback = QgsProcessingMultiStepFeedback(4, feedback)
-        
 # 1) -------------- INPUT -----------------
         elevation_model= self.parameterAsRasterLayer(parameters,self.INPUT, context)
 
@@ -129,182 +145,68 @@ class DemShadingAlgorithm(QgsProcessingAlgorithm):
         sun_angle =self.parameterAsDouble(parameters,self.ANGLE, context)
         
         smooth = self.parameterAsInt(parameters,self.SMOOTH, context)
+        frames = self.parameterAsBool(parameters,self.FRAMES, context)
+        
+        try : 
+            directions = parse_list(self.parameterAsString(parameters,self.DIRECTIONS, context))
+        except ValueError:
+            err = " \n ****** \n ERROR! \n Directions should be numbers, separated by commas !"
+            raise QgsProcessingException(err)
+        
+        directions = [d % 360 for d in directions] or [direction]
+        
+        try : 
+            angles = parse_list(self.parameterAsString(parameters,self.ANGLES, context))
+        except ValueError:
+            err = " \n ****** \n ERROR! \n Sun angles should be numbers, separated by commas !"
+            raise QgsProcessingException(err)
+        
+        if any(a < 0 or a >= 90 for a in angles):
+            err = " \n ****** \n ERROR! \n Sun angles should be between 0 and 90° !"
+            raise QgsProcessingException(err)
+        
+        angles = angles or [sun_angle]
+        
+        if frames : 
+            # one band for each pair of direction and angle (a single value is repeated)
+            n = max(len(directions), len(angles))
+            if {len(directions), len(angles)} - {1, n} : 
+                err = (" \n ****** \n ERROR! \n Animation frames : directions and angles "
+                       "should be lists of the same length (or a single value) !")
+                raise QgsProcessingException(err)
+            
+            positions = list(zip(directions * (n // len(directions)), 
+                                 angles * (n // len(angles))))
+            
+            band_names = ['frame_{}_{:g}_{:g}'.format(i + 1, d, a) 
+                          for i, (d, a) in enumerate(positions)]
+            
+        else : 
+            # one band for each direction and angle (angles of a direction are adjacent)
+            positions = [(d, a) for d in directions for a in angles]
         
-        
+            if len(angles) > 1 : 
+                band_names = ['shadow_{:g}_{:g}'.format(d, a) for d, a in positions]
+            else : band_names = ['shadow_{:g}'.format(d) for d in directions]
         
         dem = rs.Raster(elevation_model)
         
         err, fatal = dem.verify_raster()
         if err: feedback.reportError(err, fatalError = fatal)
 
-        dem.set_output(self.output_model)
+        dem.set_output(self.output_model, bands = len(positions),
+                       band_names = band_names)
                         # data_format = None : fallback to the general setting
-                        
         
-         # 2)   --------------- ORIENTATION AND DIMENSIONS -----------------
-        feedback.setCurrentStep(1)
-        if feedback.isCanceled():
-            return {}
+        # 2) -------   SHEAR, ACCUMULATE AND SAVE -------------
+        # directions with the same order of reading share the data
+        threads = int(ProcessingConfig.getSetting('THREADS') or 0)
+        # single precision : half the memory, and faster
+        dtype = np.float32 if ProcessingConfig.getSetting('COMPACT') else np.float64
         
-        # Fixing WGS bias : rectangular pixels 
-        if dem.pix_x != dem.pix_y:
-            direction = dem.angle_adjustment(direction)
-            # this method enanbles us to handle irregular pixels (eg. WGS lat/lon)
-            # we have to readjust the lighting angle: 
-            # for instance, 45° is no longler a simple diagonal 
-                
-             
-        steep =  (45 <= direction <= 135 or 225 <= direction <= 315)
-        # this is an arbitrary label for steep !
-        
-        s = direction % 90 # simplify to 90 deg range
-        if s > 45: s= 90-s # 
-
-                     
-        slope = np.tan(np.radians(s ))# matrix shear slope
-        
-        tilt= np.tan(np.radians(sun_angle)) 
-        
-             
-            
-        # ! attention: x in gdal is y dimension un numpy (the first dimension)
-        xsize, ysize = dem.xsize, dem.ysize
-        
-        if steep:
-            pixel_size = dem.pix_x * np.cos(np.radians(s)) + dem.pix_y * np.sin(np.radians(s))  
-        else:
-             pixel_size = dem.pix_x * np.sin(np.radians(s)) + dem.pix_y * np.cos(np.radians(s))   
-        
-        # ATTENTION : this method enanbles us to handle irregular pixels (eg. WGS lat/lon)
-
-        # BUT - irregular pixels also mean that we have to readjust the lighting angle !
-        # For instance, 45° is no longler a simple diagonal  - TODO !! 
-        
-        chunk = min((dem.chunk_y if steep else dem.chunk_x), (xsize if steep else ysize))
-
-        # Determine the optimal chunk size (estimate!).
-        # The problem is to carry rasterized lines 
-        # from one chunk to another. 
-        # So, set chunk size according to minimum rasterisation error
-        c = (np.arange(1, chunk) * slope) % 1 # %1 to get decimals only
-        c[c>0.5] -= 1
-        # this is not ideal : we cannot predict where it would stop
-        chunk -= np.argmin(np.round(abs(c), decimals = 2)[::-1]) +1
-        
-        feedback.setCurrentStep(2)
-        if feedback.isCanceled():
-            return {}
-        
-     
-        # writing output beforehand, to prepare for data dumps
-
-        # 3) -------   SHEAR MATRIX (INDICES) -------------
-        
-        chunk_slice = (ysize, chunk) if steep else ( chunk, xsize)
-        indices_y, indices_x = np.indices(chunk_slice)
-        mx_z = np.zeros( chunk_slice); mx_z[:] = -999999
-            
-        # this is all upside down ...
-        rev_y= 90 <= direction <= 270 
-        rev_x= not 180 <= direction <= 360
-        
-        if rev_y: indices_y = indices_y[::-1,:]
-        if not rev_x: indices_x = indices_x[:, ::-1]
-        
-        off_a = indices_x + indices_y * slope 
-        off_b = indices_y + indices_x * slope 
-        
-        if steep:
-            axis = 0
-            # construct a slope to simulate sun angle  
-            # elevations will be draped over this slope            
-            off = off_a[:, ::-1]  
-            
-            src_y = indices_x [:,::-1]
-            src_x = np.round(off_b).astype(int)          
-            
-        else:
-            axis = 1
-            off = off_b[:, ::-1]  
-
-            src_x = indices_y
-            src_y = np.round(off_a).astype(int)
-          
-        src = np.s_[src_y, src_x]        
-        
-        # x + y gives horizontal distance on x (!)
-        # for orhtogonal distance to slope prependicular, 
-        # we take cosine (given x+y is hypothenuse)
-        off *= pixel_size * np.cos(np.radians(s)) * tilt
-        
-        # create a matrix to hold the sheared matrix 
-        mx_temp = np.zeros(((np.max(src_y)+1), np.max(src_x)+1))
-        
-        t_y, t_x = mx_temp.shape
-
-        # carrying lines from one chunk to the next (fussy...)
-        if steep:        
-            l = np.s_[-1  ,  : ysize ]
-            f = np.s_[0  , t_x - ysize : ]            
-        else:
-            l = np.s_[t_y - xsize :  , -1 ]
-            f = np.s_[ : xsize, 0 ]
-            
-        last_line = np.zeros(( ysize if steep else xsize))
-        
-        feedback.setCurrentStep(3)
-        if feedback.isCanceled():
-            return {}
-        
-      # 4 -----   LOOP THOUGH DATA CHUNKS AND CALCULATE -----------------
-        counter = 0   
-        for mx_view_in, gdal_coords, mx_view_out, gdal_put in window_loop ( 
-            shape = (xsize, ysize), 
-            chunk = chunk,
-            axis = not steep, 
-            reverse = rev_x if steep else rev_y,
-            overlap= 0,
-            offset = -1) :
-      
-            dem.rst.ReadAsArray(*gdal_coords, mx_z[mx_view_in])
-                
-            # should handle better NoData !! ==> test FMAX
-            # nans will destroy the accumulation sequence
-            mask = mx_z == dem.nodata
-            mx_z[mask]= -999999        
-       
-            mx_temp[src] = mx_z + off
-                        
-            mx_temp[f] += -last_line # shadows have negative values, so *-1   
-        
-    	    # accumulate maximum shadow depths
-            mx_temp -= np.maximum.accumulate(mx_temp, axis= axis)
-            #FMAX : doesn't care about nans :)
-            #mx_temp -= np.fmax.accumulate(mx_temp, axis= axis)
-             
-                     # first line has the shadow of zero depth (nothing to accum), so copy from previous chunk
-            mx_temp[f] = last_line 
-            
-            last_line [:] = mx_temp[l ] # save for later
-
-            out = mx_temp[src] 
-            
-            if smooth:   
-                out[mx_view_out] = filter3(out[mx_view_out])
-            
-            #remove noData shadows    
-            out[mask]=np.nan   
-           
-            dem.add_to_buffer(out[mx_view_out], gdal_put,
-                              automatic_save = False ) # auto save - doesn't work with reverse reading
-
-            counter += 1
-            feedback.setProgress( 100 * chunk * counter / (xsize if steep else ysize))
-            if feedback.isCanceled(): return{}
-        
-        dem.write_output()
-        # we have to force to write the output - there is an inconsistency due to 
-        # offset = -1, which prevents the automatic save ==> to be fixed !
+        OK = shadow_depth(dem, positions, smooth = smooth, 
+                          feedback = feedback, threads = threads, 
+                          dtype = dtype)
         
         return {self.OUTPUT: self.output_model}
 
@@ -359,6 +261,14 @@ class DemShadingAlgorithm(QgsProcessingAlgorithm):
             <b>Input</b> should be an elevation model in raster format. The <b>output</b> will be smoothed where the value of each pixel is averaged with its neighbours whithin the specified radius (smooth radius). Values assigned to the output represent <b>shadow depth</b> below illuminated zones.
     
             <b>Sun direction</b> and <b>sun angle</b> parmeters define horizontal and vertical position of the sun, where 0° is on the North, 90° on the East and 270° on the West.
+            
+            <b>Multiple sun directions</b>: a list of directions, such as 0, 45, 90, 135, produces one band for each direction. The elevation model is read only once for directions that are processed in the same order (e.g. all directions between 315° and 45°).
+            
+            <b>Multiple sun angles</b>: a list of angles, such as 10, 30, 60, produces one band for each angle (and each direction, ordered by direction). Angles of the same direction share the reading of the elevation model and the calculation of distances towards the sun.
+            
+            Lists can be given as ranges, start:stop:step (e.g. 90:270:1, the last value is included).
+            
+            <b>Animation frames</b>: directions and angles are paired in order (a single value is repeated), instead of combining all directions with all angles. The output is a stack of frames, one band for each sun position (e.g. directions 90:270:2 with angles 10:55:0.5; ranges may go over 360°, such as 300:420:1). All frames are computed in a single reading of the elevation model, which is faster than running the algorithm for each frame; frames with the same direction share distances towards the sun.
 
             For more information, check <a href = "https://landscapearchaeology.org/qgis-terrain-shading/" >the manual</a>.
 	    
@@ -0,0 +1,120 @@
+# coding=utf-8
+"""Tests for the helper functions of the processing engine (numpy only)."""
+
+import unittest
+
+import numpy as np
+
+from ..modules.helpers import (line_prefix, line_sum, window_loop,
+                               tile_loop, parse_list)
+
+
+DIRECTIONS = [(0, 1), (1, 0), (1, 1), (1, -1)]
+
+
+def brute_line_sum (matrix, dy, dx, first, last, linear = False, backward = False):
+    """ Sums along lines, pixel by pixel (zero beyond matrix edges). """
+    sy, sx = matrix.shape
+    sign = -1 if backward else 1
+    out = np.zeros(matrix.shape)
+    for i in range(sy):
+        for j in range(sx):
+            for k in range(first, last + 1):
+                y, x = i + sign * k * dy, j + sign * k * dx
+                if 0 <= y < sy and 0 <= x < sx :
+                    out[i, j] += matrix[y, x] * (k if linear else 1)
+    return out
+
+
+class TestLineSums(unittest.TestCase):
+    """line_prefix and line_sum against brute force."""
+
+    def test_line_sums(self):
+        rng = np.random.default_rng(0)
+        # narrow and wide matrices : diagonals loop over different axes
+        for shape in [(7, 19), (19, 7)]:
+            matrix = rng.standard_normal(shape)
+            for dy, dx in DIRECTIONS:
+                pad = 9
+                sums = line_prefix(matrix, dy, dx, pad, second_order = True)
+                for first, last in [(1, 1), (1, 5), (3, 8)]:
+                    for linear in (False, True):
+                        for backward in (False, True):
+                            s = line_sum(sums, dy, dx, pad, shape, first, last,
+                                         linear = linear, backward = backward)
+                            np.testing.assert_allclose(
+                                s, brute_line_sum(matrix, dy, dx, first, last,
+                                                  linear, backward),
+                                atol = 1e-10)
+
+
+class TestLoops(unittest.TestCase):
+    """Chunks of window_loop and tile_loop cover the raster exactly once."""
+
+    def check_frames (self, frames, data, overlap, axes):
+        """ Axes : 0 = x, 1 = y, those with overlap. """
+        ysize, xsize = data.shape
+        count = np.zeros(data.shape, dtype = int)
+
+        for in_view, gdal_take, out_view, gdal_put in frames:
+            x_in, y_in, x_in_off, y_in_off = gdal_take
+            x, y, x_off, y_off = gdal_put
+
+            # data read for the chunk, as in a buffer larger than the chunk
+            buf = np.full((ysize + 2 * overlap * (1 in axes), 
+                           xsize + 2 * overlap * (0 in axes)), np.nan)
+            buf[in_view] = data[y_in : y_in + y_in_off, x_in : x_in + x_in_off]
+
+            np.testing.assert_array_equal(buf[in_view][out_view],
+                                          data[y : y + y_off, x : x + x_off])
+
+            # the overlap is read on both sides, except beyond raster edges
+            for axis, (a, a_off, a_in, a_in_off, size) in enumerate(
+                    [(x, x_off, x_in, x_in_off, xsize), (y, y_off, y_in, y_in_off, ysize)]):
+                ov = overlap if axis in axes else 0
+                self.assertEqual(a_in, max(a - ov, 0))
+                self.assertEqual(a_in + a_in_off, min(a + a_off + ov, size))
+
+            count[y : y + y_off, x : x + x_off] += 1
+
+        np.testing.assert_array_equal(count, 1)
+
+    def test_window_loop(self):
+        data = np.arange(23 * 17, dtype = float).reshape(23, 17)
+        for axis in (0, 1):
+            for reverse in (False, True):
+                for chunk in (1, 4, 5, 30):
+                    for overlap in (0, 2, 7):
+                        frames = list(window_loop((17, 23), chunk, axis = axis,
+                                                  reverse = reverse, overlap = overlap))
+                        self.check_frames(frames, data, overlap, [axis])
+
+                        # reversed : back to front
+                        starts = [f[3][1 if axis else 0] for f in frames]
+                        self.assertEqual(starts, sorted(starts, reverse = reverse))
+
+    def test_tile_loop(self):
+        data = np.arange(23 * 17, dtype = float).reshape(23, 17)
+        for chunk_x, chunk_y in [(1, 1), (4, 6), (17, 5), (30, 30)]:
+            for overlap in (0, 3):
+                frames = list(tile_loop((17, 23), chunk_x, chunk_y, overlap = overlap))
+                self.check_frames(frames, data, overlap, [0, 1])
+
+
+class TestParseList(unittest.TestCase):
+    """Lists of numbers and ranges."""
+
+    def test_parse_list(self):
+        self.assertEqual(parse_list('5, 10 20'), [5, 10, 20])
+        self.assertEqual(parse_list('90:180:45'), [90, 135, 180])
+        self.assertEqual(parse_list('1:3, 10', int), [1, 2, 3, 10])
+        self.assertEqual(len(parse_list('0:1:0.1')), 11)
+        self.assertEqual(parse_list('5:1'), [])
+        self.assertEqual(parse_list(''), [])
+        for text in ['a', '1:2:0', '1:2:3:4']:
+            with self.assertRaises(ValueError):
+                parse_list(text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,209 @@
+# coding=utf-8
+"""Tests for the processing engine : shaders against brute force (numpy only)."""
+
+import unittest
+
+import numpy as np
+
+from ..modules.shaders import (TPI, TPI_disc, edge_counts, weighted_line_sums,
+                               shadow_kernel, shear_shifts, hillshade_kernel)
+
+
+class MemoryRaster:
+    """ In-memory stand-in for Raster : square pixels, a single buffer. """
+
+    def __init__(self, z, chunk, bands = 1):
+        self.z = z
+        self.ysize, self.xsize = z.shape
+        self.pix_x = self.pix_y = 1.
+        self.chunk_x = self.chunk_y = chunk
+        self.rst = self
+        self.buffer = np.zeros(((bands,) if bands > 1 else ()) + z.shape)
+
+    def ReadAsArray(self, x, y, x_off, y_off):
+        return self.z[y : y + y_off, x : x + x_off].copy()
+
+    def add_to_buffer(self, matrix, gdal_put, **kwargs):
+        x, y, x_off, y_off = gdal_put
+        self.buffer[..., y : y + y_off, x : x + x_off] = matrix
+
+
+class Feedback:
+    def setProgress(self, p): pass
+    def isCanceled(self): return False
+
+
+def step_weight (mode, radius, d):
+    if mode == 1 : return d
+    if mode == 2 : return radius + 1 - d
+    return 1.
+
+
+def brute_TPI (z, offsets):
+    """ Elevation minus the weighted mean of valid neighbours : offsets are (dy, dx, weight). """
+    sy, sx = z.shape
+    out = np.full(z.shape, np.nan)
+    for i in range(sy):
+        for j in range(sx):
+            if np.isnan(z[i, j]) : continue
+            s = w = 0
+            for dy, dx, weight in offsets:
+                y, x = i + dy, j + dx
+                if 0 <= y < sy and 0 <= x < sx and not np.isnan(z[y, x]):
+                    s += z[y, x] * weight ; w += weight
+            if w : out[i, j] = z[i, j] - s / w
+    return out
+
+
+def line_offsets (radius, mode, star = False):
+    lines = [(0, 1, 1.), (1, 0, 1.)]
+    if star : lines += [(1, 1, 1 / np.sqrt(2)), (1, -1, 1 / np.sqrt(2))]
+    return [(sign * k * dy, sign * k * dx, w * step_weight(mode, radius, k))
+            for dy, dx, w in lines for k in range(1, radius + 1) for sign in (1, -1)]
+
+
+def disc_offsets (radius, inner_radius, mode):
+    out = []
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            d = np.hypot(dy, dx)
+            if 0 < d <= radius and d >= inner_radius :
+                out.append((dy, dx, step_weight(mode, radius, d)))
+    return out
+
+
+def dem_data (shape = (23, 31), nodata = True):
+    z = np.random.default_rng(1).standard_normal(shape).cumsum(0).cumsum(1) + 100
+    if nodata : z[5, 7] = z[15:17, 20:23] = np.nan
+    return z
+
+
+class TestLineTPI(unittest.TestCase):
+    """Line neighbourhoods : cumulative sums against brute force."""
+
+    def test_line_sums_and_counts(self):
+        rng = np.random.default_rng(0)
+        matrix = rng.standard_normal((13, 17))
+        for dy, dx in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+            for mode in (0, 1, 2):
+                radius = 4
+                out = [np.zeros(matrix.shape)]
+                weighted_line_sums(out, matrix, dy, dx, mode, [radius])
+                offsets = [(sign * k * dy, sign * k * dx, step_weight(mode, radius, k))
+                           for k in range(1, radius + 1) for sign in (1, -1)]
+                ones = np.ones(matrix.shape)
+                expected, counts = np.zeros(matrix.shape), np.zeros(matrix.shape)
+                for oy, ox, w in offsets:
+                    for i, j in np.ndindex(matrix.shape):
+                        y, x = i + oy, j + ox
+                        if 0 <= y < 13 and 0 <= x < 17 :
+                            expected[i, j] += matrix[y, x] * w ; counts[i, j] += w
+                np.testing.assert_allclose(out[0], expected, atol = 1e-9)
+
+                c = np.zeros(matrix.shape)
+                for sl, cnt in edge_counts(matrix.shape, radius, ((dy, dx, 1, 0),), mode):
+                    c[sl] = cnt
+                np.testing.assert_allclose(c, counts, atol = 1e-9)
+
+    def test_TPI(self):
+        z = dem_data()
+        for mode in (0, 1, 2):
+            for denoise in (None, 1):
+                for chunk in (5, 40):
+                    dem = MemoryRaster(z, chunk, bands = 2)
+                    TPI(dem, mode, 3, denoise = denoise, feedback = Feedback(), radii = [2, 3])
+                    for band, radius in enumerate([2, 3]):
+                        np.testing.assert_allclose(
+                            dem.buffer[band],
+                            brute_TPI(z, line_offsets(radius, mode, denoise == 1)),
+                            atol = 1e-8)
+
+
+class TestDiscTPI(unittest.TestCase):
+    """Disc and annulus neighbourhoods : FFT convolution against brute force."""
+
+    def test_TPI_disc(self):
+        z = dem_data()
+        for mode in (0, 1, 2):
+            for inner_radius in (0, 2):
+                for chunk in (6, 40):
+                    dem = MemoryRaster(z, chunk, bands = 2)
+                    TPI_disc(dem, mode, 4, inner_radius, feedback = Feedback(), radii = [3, 4])
+                    for band, radius in enumerate([3, 4]):
+                        np.testing.assert_allclose(
+                            dem.buffer[band],
+                            brute_TPI(z, disc_offsets(radius, inner_radius, mode)),
+                            atol = 1e-6)
+
+
+def brute_shadow (v, slope):
+    """ Shadow depth in the traversal frame : lines are pixels (i, j) with the same j - shift(i). """
+    n, m = v.shape
+    line = np.arange(m)[None, :] - shear_shifts(0, n, slope)[:, None]
+    out = np.empty(v.shape)
+    for i in range(n):
+        for j in range(m):
+            out[i, j] = v[i, j] - v[: i + 1][line[: i + 1] == line[i, j]].max()
+    return out
+
+
+class TestShadows(unittest.TestCase):
+    """Shadow depth : streamed shear against brute force."""
+
+    def run_kernel (self, v, slope, chunk, bands = 1):
+        n, m = v.shape
+        last_line = np.full(m + shear_shifts(n - 1, 1, slope)[0], -np.inf)
+        out = np.empty(v.shape)
+        size = -(-last_line.size // bands)
+        for start in range(0, n, chunk):
+            for first in range(0, last_line.size, size):
+                shadow_kernel(v[start : start + chunk], out[start : start + chunk],
+                              start, slope, last_line, (first, first + size))
+        return out
+
+    def test_kernel(self):
+        v = np.random.default_rng(2).standard_normal((19, 11)).cumsum(0)
+        for slope in (0, 0.37, 0.5, 1):
+            expected = brute_shadow(v, slope)
+            for chunk in (1, 4, 19):
+                for bands in (1, 3):
+                    np.testing.assert_allclose(
+                        self.run_kernel(v, slope, chunk, bands), expected)
+
+    def test_pillar(self):
+        # flat ground with a pillar, the sun along columns : a shadow of H / tilt pixels
+        n, m, H, tilt = 20, 5, 10., 2.
+        z = np.zeros((n, m))
+        z[3, 2] = H
+        v = z + tilt * np.arange(n)[:, None]
+        out = self.run_kernel(v, 0, 7)
+
+        expected = np.zeros((n, m))
+        i = np.arange(4, n)
+        expected[4:, 2] = np.minimum(0, (i - 3) * tilt - H)
+        np.testing.assert_allclose(out, expected)
+        self.assertEqual((out < 0).sum(), 4)
+
+
+class TestHillshade(unittest.TestCase):
+    """Algebraic hillshade against the trigonometric form."""
+
+    def test_kernel(self):
+        rng = np.random.default_rng(3)
+        lon_z, lat_z = rng.standard_normal((2, 6, 7)) * 3
+        s, fx, fy = np.radians(35), 0.7, 1.3
+
+        def shade (x, y):
+            return np.cos(np.arctan(x) - s) * np.cos(np.arctan(y))
+
+        for bidirectional in (False, True):
+            out = np.zeros(lon_z.shape)
+            hillshade_kernel(out, lon_z, lat_z, s, fx, fy, weight = 0.5,
+                             bidirectional = bidirectional)
+            expected = 0.5 * shade(lon_z * fx, lat_z * fy)
+            if bidirectional : expected += 0.5 * shade(-lat_z * fx, lon_z * fy)
+            np.testing.assert_allclose(out, expected, atol = 1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -39,6 +39,7 @@ from qgis.core import (QgsProcessing,
                         QgsProcessingParameterBoolean,
                       QgsProcessingParameterNumber,
                        QgsProcessingParameterEnum,
+                       QgsProcessingParameterString,
                        QgsProcessingUtils,
                         QgsRasterBandStats,
                        QgsSingleBandGrayRenderer,
@@ -51,10 +52,9 @@ try:
 except ImportError:
     import gdal
 
-import numpy as np
-
 from .modules import Raster as rs
-from .modules.helpers import window_loop, nextprod
+from .modules.shaders import texture_tiled, texture_separable
+from .modules.helpers import parse_list
 
 
 from qgis.core import QgsMessageLog # for testing
@@ -70,8 +70,13 @@ class TextureAlgorithm(QgsProcessingAlgorithm):
 
     INPUT = 'INPUT'
     ALPHA= 'ALPHA'
+    ALPHAS = 'ALPHAS'
+    METHOD = 'METHOD'
+    OVERLAP = 'OVERLAP'
     OUTPUT = 'OUTPUT'
 
+    METHODS = ['2D tiles (isotropic)', 'Separable (fast, approximate)']
+
     output_model = None #for post-processing
 
     def initAlgorithm(self, config):
@@ -92,6 +97,23 @@ class TextureAlgorithm(QgsProcessingAlgorithm):
             QgsProcessingParameterNumber.Double, 
             defaultValue = 0.5, minValue= 0, maxValue= 1))
         
+        self.addParameter(QgsProcessingParameterString(
+            self.ALPHAS,
+            self.tr('Multiple alphas (comma separated, overrides alpha)'),
+            optional = True))
+        
+        self.addParameter(QgsProcessingParameterEnum (
+            self.METHOD,
+            self.tr('Method'),
+            self.METHODS,
+            defaultValue=1))
+        
+        self.addParameter(QgsProcessingParameterNumber(
+            self.OVERLAP,
+            self.tr('Tile overlap (2D tiles, fraction of the tile size)'),
+            QgsProcessingParameterNumber.Double, 
+            defaultValue = 0.25, minValue= 0.1, maxValue= 0.45))
+        
         self.addParameter(
             QgsProcessingParameterRasterDestination(
                 self.OUTPUT,
@@ -120,74 +142,36 @@ class TextureAlgorithm(QgsProcessingAlgorithm):
        
         alpha =self.parameterAsDouble(parameters,self.ALPHA, context)
         
+        try : 
+            alphas = parse_list(self.parameterAsString(parameters,self.ALPHAS, context))
+        except ValueError:
+            err = " \n ****** \n ERROR! \n Alphas should be numbers, separated by commas !"
+            raise QgsProcessingException(err)
+        
+        alphas = alphas or [alpha]
+        if min(alphas) < 0 or max(alphas) > 1 : 
+            raise QgsProcessingException(" \n ****** \n ERROR! \n Alphas should be between 0 and 1 !")
+        
+        method = self.parameterAsInt(parameters,self.METHOD, context)
+        overlap = self.parameterAsDouble(parameters,self.OVERLAP, context)
+        
                 
         dem = rs.Raster(elevation_model)
         
         err, fatal = dem.verify_raster()
         if err: feedback.reportError(err, fatalError = fatal)
         
-        dem.set_output(self.output_model ) 
-        
-      #  dem.texture(alpha, feedback_handle=feedback)
+        dem.set_output(self.output_model, bands = len(alphas),
+                       band_names = ['texture_a{}'.format(a) for a in alphas]) 
         
-        chunk_slice_x = (dem.ysize, dem.chunk_x ) 
-        chunk_slice_y = (dem.chunk_y, dem.xsize) 
-              
-        # define empty matrices to hold data : faster
-        mx_z_x = np.zeros( chunk_slice_x)
-        mx_z_y = np.zeros( chunk_slice_y)
+        cache = ProcessingConfig.getSetting('DISK_CACHE')
         
-   
-   
-        Ny = nextprod([2, 3, 5, 7], dem.ysize) 
-        Nx = nextprod([2, 3, 5, 7], dem.xsize)
-        fy = np.fft.rfftfreq(Ny)[:, np.newaxis].astype(mx_z_y.dtype)
-        fx = np.fft.rfftfreq(Nx)[np.newaxis, :].astype(mx_z_x.dtype)
+        if method : 
+            OK = texture_separable(dem, alphas, feedback = feedback, cache = cache)
+        else :
+            OK = texture_tiled(dem, alphas, feedback = feedback, cache = cache, 
+                               halo = overlap)
         
-        # this is not the correct formula ; orginally :
-        # H = (fy**2 + fx**2 ) ** (alpha / 2.0)
-        # when alpha = 1 : the result is identical (i.e. pure laplacian filter)
-        Hy, Hx = ((fy** 2) ** alpha)  , ((fx ** 2) ** alpha)
-                     
-        counter = 0
-        
-        # Break the operation to two axes (x, y) : this works fine for laplacian filter,
-        # but it does not quite work for the *fractional* laplacian (here fraction = alpha)
-        # the result is only very slightly degraded for alpha = 0.5 ...
-        for axis in [0,1]:
-            if axis:
-                chunk = dem.chunk_y
-                mx_z = mx_z_y
-                N, H = Nx, Hx # bit messy x, y swaps..
-            else: 
-                chunk = dem.chunk_x
-                mx_z = mx_z_x
-                N, H = Ny, Hy 
-       
-            for mx_view_in, gdal_take, mx_view_out, gdal_put in window_loop ( 
-                    shape = (dem.xsize, dem.ysize), 
-                    chunk = chunk,
-                    axis = axis) :
-                
-                #dem.rst.ReadAsArray(*gdal_take, mx_z[mx_view_in])
-                dem.take(gdal_take, mx_z[mx_view_in], fill_nodata = 0)
-                        
-                r = np.fft.rfft( mx_z, N, axis=axis) * H
-                r = np.fft.irfft(r, axis=axis)
-                
-                # Return the same size as input
-                out = r [:mx_z.shape[0], :mx_z.shape[1]]
-                
-                # axis = 1 : second round, add old data
-                dem.add_to_buffer(out[mx_view_out], gdal_put, 
-                                   mode = rs.ADD if axis else rs.DUMP, 
-                                   automatic_save = axis)
-          
-                counter += 1
-                feedback.setProgress(100 * chunk * (counter / (dem.xsize + dem.ysize)))
-                if feedback.isCanceled(): return{}
-        
-#        
         return {self.OUTPUT: self.output_model}
 
     def postProcessAlgorithm(self, context, feedback):
@@ -241,7 +225,15 @@ class TextureAlgorithm(QgsProcessingAlgorithm):
              
 	     The alpha parameter controls the impact of wave-forms over elevation: when set to zero, pure elevation will be returned, when set to one, only the "noise" will be retained. The optimal value is approx 0.5.
              
-	     IMPORTANT: the elevation model should not contain "NoData", i.e. empty data. These will introduce large stripes across the output raster. 
+	     Multiple alphas: a list such as 0.3, 0.5, 0.7 produces one band for each alpha. The elevation model is read and transformed only once.
+             
+	     Method: the isotropic filter is applied by 2D Fourier transforms over overlapping tiles, so that memory use depends on the chunk size (see plugin settings) rather than on the raster size. Tile outputs are cross-faded over the overlap, so that no seams appear between tiles. The separable method (default) filters rows and columns in turn : it is several times faster, but only approximate for alpha other than 1 (some directional artefacts may appear).
+             
+	     Tiles are not exact: for alpha below 1 the filter reaches beyond the tile overlap. Compared to a single transform of the whole raster, differences for alpha = 0.5 are about 1 % (rms) of the output standard deviation with 1 megapixel tiles, and up to 5 % locally; about 5 % (rms) with 0.16 megapixel tiles, and up to 23 % locally. They are below 0.5 % (rms) for alpha = 0.75, and negligible for alpha = 1. Larger data chunks (plugin settings) reduce the differences. A larger tile overlap reduces the local maximum, but processing is slower (three times slower at 0.35).
+             
+	     Disk cache: when enabled in plugin settings, Fourier transforms of the elevation model are saved in the cache folder. Subsequent runs on the same file, with a different alpha, will be about twice as fast. Cache files are large (several times the size of the elevation model) and should be deleted manually. Cached data is identified by the file path, modification time, size and a sample of the content, not by a full checksum : if the elevation model is rewritten in place with the same size (e.g. by a script, within a second), delete its cache files. 
+             
+	     NoData is replaced by the mean elevation. Large NoData areas may still produce artefacts along their edges, especially with the separable method.
              
 	     For more information, check <a href = "https://landscapearchaeology.org/qgis-terrain-shading/" >the manual</a>.
              
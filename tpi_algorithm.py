@@ -39,6 +39,7 @@ from qgis.core import (QgsProcessing,
                       QgsProcessingParameterNumber,
                        QgsProcessingParameterEnum,
                        QgsProcessingParameterMatrix,
+                       QgsProcessingParameterString,
                        QgsProcessingUtils,
                         QgsRasterBandStats,
                        QgsSingleBandGrayRenderer,
@@ -54,7 +55,8 @@ except ImportError:
 import numpy as np
 
 from .modules import Raster as rs
-from .modules.shaders import TPI
+from .modules.shaders import TPI, TPI_disc
+from .modules.helpers import parse_list
 
 
 
@@ -71,6 +73,10 @@ class TpiAlgorithm(QgsProcessingAlgorithm):
 
     INPUT = 'INPUT'
     RADIUS= 'RADIUS'
+    RADII = 'RADII'
+    NEIGHBOURHOOD = 'NEIGHBOURHOOD'
+    INNER_RADIUS = 'INNER_RADIUS'
+    NORMALISE = 'NORMALISE'
     DENOISE = 'DENOISE'
     ANALYSIS_TYPE='ANALYSIS_TYPE'
     OFFSET_DISTANCE = 'OFFSET_DISTANCE'
@@ -79,6 +85,7 @@ class TpiAlgorithm(QgsProcessingAlgorithm):
 
     ANALYSIS_TYPES = ['Simple',  'Distance weighted', "Inverse dist. weighted", 'Height weighted']
     DENOISE_TYPES= ['None', 'Mean', 'Median', 'Mean and median']
+    NEIGHBOURHOODS = ['Lines (cross or star)', 'Disc', 'Annulus']
     
     output_model = None #for post-processing
 
@@ -106,6 +113,28 @@ class TpiAlgorithm(QgsProcessingAlgorithm):
             QgsProcessingParameterNumber.Integer ,
             defaultValue=5))
         
+        self.addParameter(QgsProcessingParameterString(
+            self.RADII,
+            self.tr('Multiple radii (comma separated, overrides radius)'),
+            optional = True))
+        
+        self.addParameter(QgsProcessingParameterEnum (
+            self.NEIGHBOURHOOD,
+            self.tr('Neighbourhood shape'),
+            self.NEIGHBOURHOODS,
+            defaultValue=0))
+        
+        self.addParameter(QgsProcessingParameterNumber(
+            self.INNER_RADIUS,
+            self.tr('Inner radius in pixels (annulus)'),
+            QgsProcessingParameterNumber.Integer ,
+            defaultValue=0, minValue = 0))
+        
+        self.addParameter(QgsProcessingParameterBoolean(
+            self.NORMALISE,
+            self.tr('Normalise by local standard deviation (DEV)'),
+            False, False))
+        
         self.addParameter(QgsProcessingParameterEnum(
             self.DENOISE,
             self.tr('Denoise'),
@@ -126,6 +155,16 @@ class TpiAlgorithm(QgsProcessingAlgorithm):
         
         radius = self.parameterAsInt(parameters,self.RADIUS, context)
         
+        try : 
+            radii = parse_list(self.parameterAsString(parameters,self.RADII, context), int)
+        except ValueError:
+            err = " \n ****** \n ERROR! \n Radii should be integers, separated by commas !"
+            raise QgsProcessingException(err)
+        
+        radii = sorted(set(radii)) if radii else [radius]
+        if radii[0] < 1 : 
+            raise QgsProcessingException(" \n ****** \n ERROR! \n Radii should be positive !")
+        
         """ exclusion of pixels doesn't seem very useful
         exclude = int(ProcessingConfig.getSetting('EXCLUDE_PIX'))
         if radius <= exclude :
@@ -139,6 +178,19 @@ class TpiAlgorithm(QgsProcessingAlgorithm):
         mode = self.parameterAsInt(parameters,self.ANALYSIS_TYPE, context)
 
         denoise = self.parameterAsInt(parameters,self.DENOISE, context) 
+        
+        normalise = self.parameterAsBool(parameters,self.NORMALISE, context)
+        
+        shape = self.parameterAsInt(parameters,self.NEIGHBOURHOOD, context)
+        inner_radius = self.parameterAsInt(parameters,self.INNER_RADIUS, context) if shape == 2 else 0
+        
+        if shape and mode == 3 : 
+            err = " \n ****** \n ERROR! \n Height weighted TPI is only possible with lines !"
+            raise QgsProcessingException(err)
+        
+        if inner_radius >= radii[0] : 
+            err = " \n ****** \n ERROR! \n Inner radius should be smaller than the radius !"
+            raise QgsProcessingException(err)
               
         dem = rs.Raster(elevation_model)
         
@@ -146,11 +198,20 @@ class TpiAlgorithm(QgsProcessingAlgorithm):
         if err: feedback.reportError(err, fatalError = fatal)
         
 
-        dem.set_output(self.output_model) 
+        dem.set_output(self.output_model, bands = len(radii),
+                       band_names = ['TPI_r{}'.format(r) for r in radii]) 
             
-        OK = TPI(dem_class=dem, mode=mode, radius=radius,
-                 denoise = denoise,
-                 feedback=feedback)
+        if shape : 
+            OK = TPI_disc(dem_class=dem, mode=mode, radius=radii[-1],
+                          inner_radius = inner_radius,
+                          denoise = denoise,
+                          feedback=feedback, radii = radii, 
+                          normalise = normalise)
+        else : 
+            OK = TPI(dem_class=dem, mode=mode, radius=radii[-1],
+                     denoise = denoise,
+                     feedback=feedback, radii = radii, 
+                     normalise = normalise)
         
              
         return {self.OUTPUT: self.output_model}
@@ -206,10 +267,18 @@ class TpiAlgorithm(QgsProcessingAlgorithm):
             <b>Input</b> should be an elevation model in raster format. 
             
             <b>Radius</b> defines the search radius (in pixels).
+            
+            <b>Multiple radii</b>: a list of radii, such as 5, 10, 20, produces a multi-scale TPI, with one band for each radius. The data is read only once and smaller radii are obtained on the way to the largest one. 
 
             There are 3 <b>analysis types</b>: 1) standard TPI, 2) distance weighted and 3) height weighted. Weighted options use elevation point distance or height discrepancy as weighting factor.   
             
-            <b>Denoise</b> apply a smoothing filter. 
+            <b>Neighbourhood shape</b>: lines radiating from each pixel (faster for short radii) or a disc or annulus (ring), computed by FFT convolution. Disc and annulus are isotropic and their cost hardly depends on the radius. Height weighted analysis is possible with lines only.
+            
+            <b>Inner radius</b> of the annulus : closer pixels are excluded (as in the standard TPI by Weiss). 
+            
+            <b>Normalise</b>: divide TPI by the standard deviation of elevations in the neighbourhood (deviation from mean, DEV). Normalised values can be compared between rugged and flat terrain.
+            
+            <b>Denoise</b> apply a smoothing filter. Mean filter (star shaped lines) is not used with discs and annuli. 
             
              For more information, check <a href = "https://landscapearchaeology.org/qgis-terrain-shading/" >the manual</a>.
             